@@ -8,6 +8,11 @@ import numpy as np
 from others.logging import logger
 
 
+def _as_list(ids):
+    """Shards may store id sequences as numpy arrays; batching expects lists."""
+    return ids.tolist() if isinstance(ids, np.ndarray) else ids
+
+
 
 class Batch(object):
     def _pad(self, data, pad_id, width=-1):
@@ -264,13 +269,13 @@ class DataIterator(object):
         return xs
 
     def preprocess(self, ex, is_test):
-        src = ex['src']
+        src = _as_list(ex['src'])
         tgt = ex['tgt'][:self.args.max_tgt_len][:-1]+[2]
         src_sent_labels = ex['src_sent_labels']
-        segs = ex['segs']
+        segs = _as_list(ex['segs'])
         if(not self.args.use_interval):
             segs=[0]*len(segs)
-        clss = ex['clss']
+        clss = _as_list(ex['clss'])
         src_txt = ex['src_txt']
         tgt_txt = ex['tgt_txt']
         graph_src = ex['graph_src']
@@ -403,13 +408,13 @@ class TextDataloader(object):
         return xs
 
     def preprocess(self, ex, is_test):
-        src = ex['src']
+        src = _as_list(ex['src'])
         tgt = ex['tgt'][:self.args.max_tgt_len][:-1] + [2]
         src_sent_labels = ex['src_sent_labels']
-        segs = ex['segs']
+        segs = _as_list(ex['segs'])
         if (not self.args.use_interval):
             segs = [0] * len(segs)
-        clss = ex['clss']
+        clss = _as_list(ex['clss'])
         src_txt = ex['src_txt']
         tgt_txt = ex['tgt_txt']
 
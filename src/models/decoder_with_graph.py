@@ -2,15 +2,65 @@
 Implementation of "Attention is All You Need"
 """
 
+import re
+
 import torch
 import torch.nn as nn
-import numpy as np
 
 from models.encoder import PositionalEncoding
-from models.neural import MultiHeadedAttention, PositionwiseFeedForward, DecoderState
+from models.neural import MultiHeadedAttention, PositionwiseFeedForward, DecoderState, additive_mask, linear_2d
 
 MAX_SIZE = 5000
 
+# torch.compile is usable for these layers from torch 2.1 on.
+_CAN_COMPILE = hasattr(torch, 'compile') and \
+    tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1)
+
+
+def _dec_mask(tgt_pad_mask, causal):
+    """
+    Combine the target pad mask with the causal mask.
+    """
+    return tgt_pad_mask | causal
+
+
+def _dropout_add_ln(x, residual, weight, bias, p, training, eps):
+    # type: (Tensor, Tensor, Tensor, Tensor, float, bool, float) -> Tuple[Tensor, Tensor]
+    """
+    Residual block tail `y = dropout(x) + residual` followed by layer
+    norm. Returns `(y, layer_norm(y))`.
+    """
+    y = torch.nn.functional.dropout(x, p, training) + residual
+    return y, torch.nn.functional.layer_norm(y, [y.size(-1)], weight, bias, eps)
+
+
+# Scripted so the pointwise ops and the norm fuse into fewer kernels in
+# eager mode. Compiled layers call the plain functions above instead,
+# since dynamo cannot trace into script functions.
+_build_dec_mask = torch.jit.script(_dec_mask)
+_fused_dropout_add_ln = torch.jit.script(_dropout_add_ln)
+
+_COMPILED_LAYER_RE = re.compile(r'^(transformer_layers\.\d+\.)_orig_mod\.')
+_LAYER_RE = re.compile(r'^(transformer_layers\.\d+\.)(?!_orig_mod\.)')
+
+
+def _strip_compiled_keys(module, state_dict, prefix, local_metadata):
+    """
+    Save compiled layers under their plain parameter names, so
+    checkpoints do not depend on `use_compile`.
+    """
+    for key in [k for k in state_dict if k.startswith(prefix)]:
+        value = state_dict.pop(key)
+        state_dict[prefix + _COMPILED_LAYER_RE.sub(r'\1', key[len(prefix):], 1)] = value
+
+
+def _add_compiled_keys(state_dict, prefix, *args):
+    """ Load plain parameter names into compiled layers. """
+    for key in [k for k in state_dict if k.startswith(prefix)]:
+        new_key = prefix + _LAYER_RE.sub(r'\1_orig_mod.', key[len(prefix):], 1)
+        if new_key != key:
+            state_dict[new_key] = state_dict.pop(key)
+
 
 class TransformerDecoderLayer(nn.Module):
     """
@@ -42,19 +92,25 @@ class TransformerDecoderLayer(nn.Module):
         self.layer_norm_3 = nn.LayerNorm(d_model, eps=1e-6)
 
         self.drop = nn.Dropout(dropout)
+        # Cleared for layers run under torch.compile.
+        self.use_scripted = True
         mask = self._get_attn_subsequent_mask(MAX_SIZE)
         # Register self.mask as a buffer in TransformerDecoderLayer, so
         # it gets TransformerDecoderLayer's cuda behavior automatically.
         self.register_buffer('mask', mask)
 
     def forward(self, inputs, memory_bank, g_memory, src_pad_mask, g_memory_mask, tgt_pad_mask,
-                previous_input=None, layer_cache=None, step=None):
+                previous_input=None, layer_cache=None, step=None,
+                memory_kv=None, g_memory_kv=None):
         """
         Args:
             inputs (`FloatTensor`): `[batch_size x 1 x model_dim]`
             memory_bank (`FloatTensor`): `[batch_size x src_len x model_dim]`
-            src_pad_mask (`LongTensor`): `[batch_size x 1 x src_len]`
-            tgt_pad_mask (`LongTensor`): `[batch_size x 1 x 1]`
+            src_pad_mask (`FloatTensor`): `[batch_size x 1 x 1 x src_len]`
+            g_memory_mask (`FloatTensor`): `[batch_size x 1 x 1 x g_len]`
+            tgt_pad_mask (`BoolTensor`): `[batch_size x 1 x 1 x tgt_len]`
+            memory_kv, g_memory_kv (`(FloatTensor, FloatTensor)`):
+                precomputed cross-attention keys and values, if any
 
         Returns:
             (`FloatTensor`, `FloatTensor`, `FloatTensor`):
@@ -64,9 +120,13 @@ class TransformerDecoderLayer(nn.Module):
             * all_input `[batch_size x current_step x model_dim]`
 
         """
-        dec_mask = torch.gt(tgt_pad_mask +
-                            self.mask[:, :tgt_pad_mask.size(1),
-                                      :tgt_pad_mask.size(1)], 0)
+        if self.use_scripted:
+            build_dec_mask, dropout_add_ln = _build_dec_mask, _fused_dropout_add_ln
+        else:
+            build_dec_mask, dropout_add_ln = _dec_mask, _dropout_add_ln
+        tgt_len = tgt_pad_mask.size(-1)
+        dec_mask = build_dec_mask(tgt_pad_mask.bool(),
+                                  self.mask[:, None, :tgt_len, :tgt_len])
         # 1) self attention
         input_norm = self.layer_norm_1(inputs)
         all_input = input_norm
@@ -78,23 +138,27 @@ class TransformerDecoderLayer(nn.Module):
                                      mask=dec_mask,
                                      layer_cache=layer_cache,
                                      type="self")
-        query = self.drop(query) + inputs
+        query, query_norm = dropout_add_ln(
+            query, inputs, self.layer_norm_2.weight, self.layer_norm_2.bias,
+            self.drop.p, self.training, self.layer_norm_2.eps)
 
         # 2) context attention with graph encoding
-        query_norm = self.layer_norm_2(query)
         #print(query_norm.shape, g_memory.shape)
         query_graph = self.graph_attn(g_memory, g_memory, query_norm,
                                         mask=g_memory_mask,
                                         layer_cache=layer_cache,
-                                        type="g_context")
-        query_g = self.drop(query_graph) + query
+                                        type="g_context",
+                                        memory_kv=g_memory_kv)
+        query_g, query_g_norm = dropout_add_ln(
+            query_graph, query, self.layer_norm_3.weight, self.layer_norm_3.bias,
+            self.drop.p, self.training, self.layer_norm_3.eps)
 
         # 3) context attention with bert encoding
-        query_g_norm = self.layer_norm_3(query_g)
         mid = self.context_attn(memory_bank, memory_bank, query_g_norm,
                                       mask=src_pad_mask,
                                       layer_cache=layer_cache,
-                                      type="context")
+                                      type="context",
+                                      memory_kv=memory_kv)
         output = self.feed_forward(self.drop(mid) + query)
 
         return output, all_input
@@ -107,14 +171,11 @@ class TransformerDecoderLayer(nn.Module):
             size: int
 
         Returns:
-            (`LongTensor`):
+            (`BoolTensor`):
 
             * subsequent_mask `[1 x size x size]`
         """
-        attn_shape = (1, size, size)
-        subsequent_mask = np.triu(np.ones(attn_shape), k=1).astype('uint8')
-        subsequent_mask = torch.from_numpy(subsequent_mask)
-        return subsequent_mask
+        return torch.ones((1, size, size), dtype=torch.bool).triu_(diagonal=1)
 
 
 
@@ -146,9 +207,12 @@ class TransformerDecoderWithGraph(nn.Module):
        embeddings (:obj:`onmt.modules.Embeddings`):
           embeddings to use, should have positional encodings
        attn_type (str): if using a seperate copy attention
+       use_compile (bool): wrap each layer in `torch.compile`; ignored
+          when torch is older than 2.1
     """
 
-    def __init__(self, num_layers, d_model, heads, d_ff, dropout, embeddings):
+    def __init__(self, num_layers, d_model, heads, d_ff, dropout, embeddings,
+                 use_compile=False):
         super(TransformerDecoderWithGraph, self).__init__()
 
         # Basic attributes.
@@ -162,9 +226,36 @@ class TransformerDecoderWithGraph(nn.Module):
         self.transformer_layers = nn.ModuleList(
             [TransformerDecoderLayer(d_model, heads, d_ff, dropout)
              for _ in range(num_layers)])
+        if use_compile and _CAN_COMPILE:
+            # Shapes vary with tgt_len and the decoding step, hence
+            # dynamic=True. The hooks keep checkpoint keys free of the
+            # wrapper's `_orig_mod.` prefix.
+            for layer in self.transformer_layers:
+                layer.use_scripted = False
+            self.transformer_layers = nn.ModuleList(
+                [torch.compile(layer, dynamic=True) for layer in self.transformer_layers])
+            self._register_state_dict_hook(_strip_compiled_keys)
+            self._register_load_state_dict_pre_hook(_add_compiled_keys)
 
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
 
+    def _memory_kv(self, memory, attn_name):
+        """
+        Project `memory` to keys and values for every layer's `attn_name`
+        attention in one GEMM over the stacked per-layer weights.
+
+        Returns:
+            list of `(keys, values)`, one per layer, each
+            `[batch x mem_len x model_dim]`
+        """
+        attns = [getattr(layer, attn_name) for layer in self.transformer_layers]
+        d = attns[0].model_dim
+        weight = torch.cat([attn.linear_qkv.weight[d:] for attn in attns], 0)
+        bias = torch.cat([attn.linear_qkv.bias[d:] for attn in attns], 0)
+        kv = linear_2d(memory, weight, bias)
+        return [layer_kv.chunk(2, dim=-1)
+                for layer_kv in kv.chunk(self.num_layers, dim=-1)]
+
     def forward(self, tgt, memory_bank, g_memory, state, memory_lengths=None,
                 step=None, cache=None, memory_masks=None, g_masks=None):
         """
@@ -173,9 +264,6 @@ class TransformerDecoderWithGraph(nn.Module):
         src_words = state.src
         g_words = state.g_src
         tgt_words = tgt
-        src_batch, src_len = src_words.size()
-        g_batch, g_len = g_words.size()
-        tgt_batch, tgt_len = tgt_words.size()
         # Run the forward pass of the TransformerDecoder.
         # emb = self.embeddings(tgt, step=step)
         emb = self.embeddings(tgt)
@@ -186,25 +274,39 @@ class TransformerDecoderWithGraph(nn.Module):
         src_memory_bank = memory_bank
         padding_idx = self.embeddings.padding_idx
         
-        tgt_pad_mask = tgt_words.data.eq(padding_idx).unsqueeze(1) \
-            .expand(tgt_batch, tgt_len, tgt_len)
+        # Pad masks are built once as `[batch x 1 x 1 x len]` and broadcast
+        # over heads and query positions inside every layer. The memory
+        # masks are also turned into additive float masks here rather than
+        # in each attention call.
+        tgt_pad_mask = tgt_words.eq(padding_idx)[:, None, None, :]
 
         if (not memory_masks is None):
-            src_len = memory_masks.size(-1)
-            src_pad_mask = memory_masks.expand(src_batch, tgt_len, src_len)
+            src_pad_mask = additive_mask(memory_masks, output.dtype).unsqueeze(1)
         else:
-            src_pad_mask = src_words.data.eq(padding_idx).unsqueeze(1) \
-                .expand(src_batch, tgt_len, src_len)
+            src_pad_mask = additive_mask(
+                src_words.eq(padding_idx)[:, None, None, :], output.dtype)
 
         if (not g_masks is None):
-            g_len = g_masks.size(-1)
-            g_pad_mask = g_masks.expand(g_batch, tgt_len, g_len)
+            g_pad_mask = additive_mask(g_masks, output.dtype).unsqueeze(1)
         else:
-            g_pad_mask = g_words.data.eq(padding_idx).unsqueeze(1) \
-                .expand(g_batch, tgt_len, g_len)
+            g_pad_mask = additive_mask(
+                g_words.eq(padding_idx)[:, None, None, :], output.dtype)
+
+        # Keys and values over the memory banks are only needed when they
+        # are not already in the decoding cache.
+        memory_kvs = g_memory_kvs = [None] * self.num_layers
+        if state.cache is None or state.cache[0]["memory_keys"] is None:
+            memory_kvs = self._memory_kv(src_memory_bank, 'context_attn')
+            g_memory_kvs = self._memory_kv(g_memory, 'graph_attn')
 
         if state.cache is None:
-            saved_inputs = []
+            # Every layer returns all_input of the same shape, so write
+            # them straight into one buffer instead of stacking a list.
+            saved_len = tgt_words.size(1)
+            if state.previous_input is not None:
+                saved_len += state.previous_layer_inputs.size(2)
+            saved_inputs = output.new_empty(
+                (self.num_layers, output.size(0), saved_len, output.size(2)))
 
         for i in range(self.num_layers):
             prev_layer_input = None
@@ -216,13 +318,13 @@ class TransformerDecoderWithGraph(nn.Module):
                     output, src_memory_bank, g_memory,
                     src_pad_mask, g_pad_mask, tgt_pad_mask,
                     previous_input=prev_layer_input,
-                    layer_cache=state.cache["layer_{}".format(i)]
+                    layer_cache=state.cache[i]
                     if state.cache is not None else None,
-                    step=step)
+                    step=step,
+                    memory_kv=memory_kvs[i],
+                    g_memory_kv=g_memory_kvs[i])
             if state.cache is None:
-                saved_inputs.append(all_input)
-        if state.cache is None:
-            saved_inputs = torch.stack(saved_inputs)
+                saved_inputs[i].copy_(all_input)
 
         output = self.layer_norm(output)
 
@@ -288,23 +390,20 @@ class TransformerDecoderState(DecoderState):
         return state
 
     def _init_cache(self, num_layers):
-        self.cache = {}
-
-        for l in range(num_layers):
-            layer_cache = {
-                "memory_keys": None,
-                "memory_values": None,
-                "g_memory_keys": None,
-                "g_memory_values": None
-            }
-            layer_cache["self_keys"] = None
-            layer_cache["self_values"] = None
-            self.cache["layer_{}".format(l)] = layer_cache
+        # One dict per layer, indexed by layer number.
+        self.cache = [{
+            "memory_keys": None,
+            "memory_values": None,
+            "g_memory_keys": None,
+            "g_memory_values": None,
+            "self_keys": None,
+            "self_values": None
+        } for _ in range(num_layers)]
 
     def repeat_beam_size_times(self, beam_size):
         """ Repeat beam_size times along batch dimension. """
-        self.src = self.src.data.repeat(1, beam_size, 1)
-        self.g_src = self.src.data.repeat(1, beam_size, 1)
+        self.src = self.src.repeat_interleave(beam_size, dim=0)
+        self.g_src = self.g_src.repeat_interleave(beam_size, dim=0)
 
     def map_batch_fn(self, fn):
         def _recursive_map(struct, batch_dim=0):
@@ -318,7 +417,8 @@ class TransformerDecoderState(DecoderState):
         self.src = fn(self.src, 0)
         self.g_src = fn(self.g_src, 0)
         if self.cache is not None:
-            _recursive_map(self.cache)
+            for layer_cache in self.cache:
+                _recursive_map(layer_cache)
 
 
 
@@ -5,15 +5,20 @@ This includes: LossComputeBase and the standard NMTLossCompute, and
                sharded loss compute stuff.
 """
 from __future__ import division
+import inspect
+import math
+
 import torch
-import GPUtil
-import wandb
 import torch.nn as nn
 import torch.nn.functional as F
 
 from models.reporter import Statistics
 from fastNLP.core import seq_len_to_mask
 
+# torch >= 1.10 computes label smoothing inside cross_entropy without
+# materialising the smoothed target distribution.
+_FUSED_LABEL_SMOOTHING = 'label_smoothing' in inspect.signature(F.cross_entropy).parameters
+
 def abs_loss(generator, symbols, vocab_size, device, train=True, label_smoothing=0.0):
     compute = NMTLossCompute(
         generator, symbols, vocab_size,
@@ -137,7 +142,6 @@ class LossComputeBase(nn.Module):
             del stats
         del graph
         del shard_state
-        torch.cuda.empty_cache()
 
         return batch_stats
 
@@ -151,16 +155,19 @@ class LossComputeBase(nn.Module):
         Returns:
             :obj:`onmt.utils.Statistics` : statistics for this batch.
         """
+        # Everything stays on the device; `Statistics.materialize()` syncs
+        # once when the numbers are reported.
         pred = scores.max(1)[1]
         non_padding = target.ne(self.padding_idx)
         num_correct = pred.eq(target) \
                           .masked_select(non_padding) \
-                          .sum() \
-                          .item()
-        num_non_padding = non_padding.sum().item()
-        contra_loss = contra_loss.item() if contra_loss != 0.0 else 0.0
-        doc_word_contra_loss = doc_word_contra_loss.item() if doc_word_contra_loss != 0.0 else 0.0
-        stat = Statistics(loss.item(), num_non_padding, num_correct, contra_loss, doc_word_contra_loss)
+                          .sum()
+        num_non_padding = non_padding.sum()
+        if torch.is_tensor(contra_loss):
+            contra_loss = contra_loss.detach()
+        if torch.is_tensor(doc_word_contra_loss):
+            doc_word_contra_loss = doc_word_contra_loss.detach()
+        stat = Statistics(loss.detach(), num_non_padding, num_correct, contra_loss, doc_word_contra_loss)
         return stat
 
     def _bottle(self, _v):
@@ -181,22 +188,27 @@ class LabelSmoothingLoss(nn.Module):
         self.padding_idx = ignore_index
         super(LabelSmoothingLoss, self).__init__()
 
-        smoothing_value = label_smoothing / (tgt_vocab_size - 2)
-        one_hot = torch.full((tgt_vocab_size,), smoothing_value)
-        one_hot[self.padding_idx] = 0
-        self.register_buffer('one_hot', one_hot.unsqueeze(0))
+        self.smoothing_value = label_smoothing / (tgt_vocab_size - 2)
         self.confidence = 1.0 - label_smoothing
+        # sum(q * log(q)) of the smoothed target q, the same for every row.
+        self.neg_entropy = (tgt_vocab_size - 2) * self.smoothing_value * math.log(self.smoothing_value)
+        if self.confidence > 0:
+            self.neg_entropy += self.confidence * math.log(self.confidence)
 
     def forward(self, output, target):
         """
         output (FloatTensor): batch_size x n_classes
         target (LongTensor): batch_size
+
+        KL(q || p) is computed in closed form from the target and padding
+        log-probs and the row sums, without building q.
         """
-        model_prob = self.one_hot.repeat(target.size(0), 1)
-        model_prob.scatter_(1, target.unsqueeze(1), self.confidence)
-        model_prob.masked_fill_((target == self.padding_idx).unsqueeze(1), 0)
+        target_lprob = output.gather(1, target.unsqueeze(1)).squeeze(1)
+        smooth_lprob = output.sum(1) - target_lprob - output[:, self.padding_idx]
+        loss = self.neg_entropy - self.confidence * target_lprob \
+            - self.smoothing_value * smooth_lprob
 
-        return F.kl_div(output, model_prob, reduction='sum')
+        return loss.masked_fill(target == self.padding_idx, 0).sum()
 
 
 class NMTLossCompute(LossComputeBase):
@@ -208,7 +220,16 @@ class NMTLossCompute(LossComputeBase):
                  label_smoothing=0.0):
         super(NMTLossCompute, self).__init__(generator, symbols['PAD'])
         self.sparse = not isinstance(generator[1], nn.LogSoftmax)
-        if label_smoothing > 0:
+        self.label_smoothing = label_smoothing
+        if label_smoothing > 0 and _FUSED_LABEL_SMOOTHING:
+            self.criterion = None
+            # Entropy of the smoothed target cross_entropy builds, the same
+            # for every non-padding row.
+            off_value = label_smoothing / vocab_size
+            on_value = 1.0 - label_smoothing + off_value
+            self.target_entropy = -(on_value * math.log(on_value)
+                                    + (vocab_size - 1) * off_value * math.log(off_value))
+        elif label_smoothing > 0:
             self.criterion = LabelSmoothingLoss(
                 label_smoothing, vocab_size, ignore_index=self.padding_idx
             )
@@ -216,7 +237,6 @@ class NMTLossCompute(LossComputeBase):
             self.criterion = nn.NLLLoss(
                 ignore_index=self.padding_idx, reduction='sum'
             )
-        self.loss = nn.CrossEntropyLoss(reduction='none')
 
     def _make_shard_state(self, batch, output, mask_src, node_num, graph, cos_sim, doc_word_cos_sim):
         return {
@@ -233,18 +253,21 @@ class NMTLossCompute(LossComputeBase):
         """
         compute the Ncontrast loss
         """
-        x_dis = torch.exp(tau * x_dis)
-        x_dis_sum = torch.sum(x_dis*mask_graph, 1)
-        #print(x_dis.shape, mask_graph.shape, adj_label.shape)
-        x_dis_sum_pos = torch.sum(x_dis * adj_label, 1)
-        reverse_x_dis_sum = x_dis_sum.masked_fill(x_dis_sum == 0, 1) ** (-1)
-        cum_prod = x_dis_sum_pos * reverse_x_dis_sum
-        cum_prod = cum_prod.masked_fill(x_dis_sum == 0, 1)
-        del x_dis_sum
-        del x_dis_sum_pos
-        del reverse_x_dis_sum
-        loss = -torch.log(cum_prod)
-        loss = loss.mean()
+        # -log(sum_pos / sum_all) in log space, so large similarities
+        # cannot overflow exp. Masked entries get the dtype minimum rather
+        # than -inf to keep the logsumexp gradients finite.
+        logits = tau * x_dis
+        neg = torch.finfo(logits.dtype).min
+        adj_label = adj_label.to(logits.dtype)
+        mask_graph = mask_graph.bool()
+        log_all = torch.logsumexp(logits.masked_fill(~mask_graph, neg), dim=1)
+        log_pos = torch.logsumexp(
+            (logits + adj_label.log()).masked_fill(adj_label <= 0, neg), dim=1)
+        # Average over the nodes that exist and have a positive pair, not
+        # over graph padding.
+        valid = mask_graph.any(1) & (adj_label > 0).any(1)
+        loss = (log_all - log_pos).masked_select(valid)
+        loss = loss.sum() / valid.sum().clamp(min=1)
         return loss
 
     def _compute_loss(self, batch, output, target, mask_src, node_num, graph, cos_sim=None, doc_word_cos_sim=None):
@@ -252,15 +275,26 @@ class NMTLossCompute(LossComputeBase):
         scores = self.generator(bottled_output)
         gtruth =target.contiguous().view(-1)
 
-        loss = self.criterion(scores, gtruth)
+        if self.criterion is None:
+            # log_softmax is idempotent, so the generator's log-probs can be
+            # passed to cross_entropy in place of logits.
+            loss = F.cross_entropy(scores, gtruth, ignore_index=self.padding_idx,
+                                   reduction='sum', label_smoothing=self.label_smoothing)
+            # cross_entropy returns H(q, p); report KL(q || p) as
+            # LabelSmoothingLoss does, so xent/ppl stay comparable.
+            stat_loss = loss - self.target_entropy * gtruth.ne(self.padding_idx).sum()
+        else:
+            loss = self.criterion(scores, gtruth)
+            stat_loss = loss
 
         if cos_sim is not None:
             doc_word_cos_sim = doc_word_cos_sim.reshape(-1, doc_word_cos_sim.size(-1))
-            labels = torch.ones(doc_word_cos_sim.size(0)).long().to(doc_word_cos_sim.device)
-            doc_word_contra_loss = self.loss(doc_word_cos_sim.squeeze(0), labels)
-            #print(doc_word_contra_loss.shape)
-            mask_src = mask_src.reshape(mask_src.shape[0]*mask_src.shape[1],-1).squeeze(-1)
-            doc_word_contra_loss = (doc_word_contra_loss * mask_src.float()).mean()
+            labels = doc_word_cos_sim.new_ones(doc_word_cos_sim.size(0), dtype=torch.long)
+            doc_word_contra_loss = F.cross_entropy(doc_word_cos_sim, labels, reduction='none')
+            # Average over real source tokens only.
+            valid = mask_src.reshape(-1).bool()
+            doc_word_contra_loss = doc_word_contra_loss.masked_select(valid).sum() \
+                / valid.sum().clamp(min=1)
 
             nn = cos_sim.size(-2)
             #print(cos_sim.shape,nn,batch_size, negative_num)
@@ -275,10 +309,10 @@ class NMTLossCompute(LossComputeBase):
             #contra_loss += each_contra_loss
             #contra_loss = contra_loss/len(graph)
             #print("contra_loss:", contra_loss)
-            mask_vec = seq_len_to_mask(node_num, max_len=nn).to(cos_sim.device)
-            mask_graph_row = torch.tile(mask_vec.unsqueeze(1), (1,nn,1))
-            mask_graph_col = torch.tile(mask_vec.unsqueeze(2), (1, 1,nn))
-            mask_graph = mask_graph_row*mask_graph_col
+            # seq_len_to_mask may return uint8; _ncontrast inverts the mask
+            # with `~`, which must be a logical not.
+            mask_vec = seq_len_to_mask(node_num, max_len=nn).to(cos_sim.device).bool()
+            mask_graph = mask_vec.unsqueeze(1) & mask_vec.unsqueeze(2)
             #print(cos_sim)
             #print(cos_sim.shape, mask_graph.shape)
             #print(graph.shape)
@@ -287,10 +321,7 @@ class NMTLossCompute(LossComputeBase):
         else:
             doc_word_contra_loss = 0.0
             contra_loss = 0.0
-        contra_loss = contra_loss.clone() if contra_loss != 0.0 else 0.0
-        doc_word_contra_loss = doc_word_contra_loss.clone() if doc_word_contra_loss != 0.0 else 0.0
-
-        stats = self._stats(loss.clone(), scores, gtruth, contra_loss, doc_word_contra_loss)
+        stats = self._stats(stat_loss, scores, gtruth, contra_loss, doc_word_contra_loss)
         loss = loss + doc_word_contra_loss + contra_loss
 
         del contra_loss
@@ -309,8 +340,9 @@ def filter_shard_state(state, shard_size=None):
             v_split = []
             if isinstance(v, torch.Tensor):
                 for v_chunk in torch.split(v, shard_size):
-                    v_chunk = v_chunk.data.clone()
-                    v_chunk.requires_grad = v.requires_grad
+                    # A detached view is a fresh leaf for the shard's
+                    # backward without copying the chunk.
+                    v_chunk = v_chunk.detach().requires_grad_(v.requires_grad)
                     v_split.append(v_chunk)
             yield k, (v, v_split)
 
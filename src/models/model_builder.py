@@ -12,28 +12,37 @@ from dgl.nn.pytorch import GraphConv
 from models.decoder_with_graph import TransformerDecoderWithGraph
 from models.decoder import TransformerDecoder
 from models.encoder import Classifier, ExtTransformerEncoder
-from models.optimizers import Optimizer
+from models.optimizers import Optimizer, remap_fused_qkv_state
 from fastNLP.core import seq_len_to_mask
 from scipy import sparse
 
+def _load_optim_state(args, optim, saved_optimizer_state_dict, params):
+    """
+    Load a checkpoint's optimizer state into the optimizer `set_parameters`
+    built for `params`, remapping state saved with split attention
+    projections.
+    """
+    optim.optimizer.load_state_dict(
+        remap_fused_qkv_state(saved_optimizer_state_dict, params))
+    if args.visible_gpus != '-1':
+        for state in optim.optimizer.state.values():
+            for k, v in state.items():
+                if torch.is_tensor(v):
+                    state[k] = v.cuda()
+
+    if (optim.method == 'adam') and (len(optim.optimizer.state) < 1):
+        raise RuntimeError(
+            "Error: loaded Adam optimizer from existing model" +
+            " but optimizer state is empty")
+
 def build_optim(args, model, checkpoint):
     """ Build optimizer """
 
     if checkpoint is not None:
         optim = checkpoint['optim'][0]
+        # set_parameters replaces optim.optimizer, so keep its state to
+        # load into the new optimizer.
         saved_optimizer_state_dict = optim.optimizer.state_dict()
-        optim.optimizer.load_state_dict(saved_optimizer_state_dict)
-        if args.visible_gpus != '-1':
-            for state in optim.optimizer.state.values():
-                for k, v in state.items():
-                    if torch.is_tensor(v):
-                        state[k] = v.cuda()
-
-        if (optim.method == 'adam') and (len(optim.optimizer.state) < 1):
-            raise RuntimeError(
-                "Error: loaded Adam optimizer from existing model" +
-                " but optimizer state is empty")
-
     else:
         optim = Optimizer(
             args.optim, args.lr, args.max_grad_norm,
@@ -41,8 +50,10 @@ def build_optim(args, model, checkpoint):
             decay_method='noam',
             warmup_steps=args.warmup_steps)
 
-    optim.set_parameters(list(model.named_parameters()))
-
+    params = list(model.named_parameters())
+    optim.set_parameters(params)
+    if checkpoint is not None:
+        _load_optim_state(args, optim, saved_optimizer_state_dict, params)
 
     return optim
 
@@ -51,19 +62,9 @@ def build_optim_bert(args, model, checkpoint):
 
     if checkpoint is not None:
         optim = checkpoint['optims'][0]
+        # set_parameters replaces optim.optimizer, so keep its state to
+        # load into the new optimizer.
         saved_optimizer_state_dict = optim.optimizer.state_dict()
-        optim.optimizer.load_state_dict(saved_optimizer_state_dict)
-        if args.visible_gpus != '-1':
-            for state in optim.optimizer.state.values():
-                for k, v in state.items():
-                    if torch.is_tensor(v):
-                        state[k] = v.cuda()
-
-        if (optim.method == 'adam') and (len(optim.optimizer.state) < 1):
-            raise RuntimeError(
-                "Error: loaded Adam optimizer from existing model" +
-                " but optimizer state is empty")
-
     else:
         optim = Optimizer(
             args.optim, args.lr_bert, args.max_grad_norm,
@@ -73,7 +74,8 @@ def build_optim_bert(args, model, checkpoint):
 
     params = [(n, p) for n, p in list(model.named_parameters()) if n.startswith('bert.model')]
     optim.set_parameters(params)
-
+    if checkpoint is not None:
+        _load_optim_state(args, optim, saved_optimizer_state_dict, params)
 
     return optim
 
@@ -82,19 +84,9 @@ def build_optim_dec(args, model, checkpoint):
 
     if checkpoint is not None:
         optim = checkpoint['optims'][1]
+        # set_parameters replaces optim.optimizer, so keep its state to
+        # load into the new optimizer.
         saved_optimizer_state_dict = optim.optimizer.state_dict()
-        optim.optimizer.load_state_dict(saved_optimizer_state_dict)
-        if args.visible_gpus != '-1':
-            for state in optim.optimizer.state.values():
-                for k, v in state.items():
-                    if torch.is_tensor(v):
-                        state[k] = v.cuda()
-
-        if (optim.method == 'adam') and (len(optim.optimizer.state) < 1):
-            raise RuntimeError(
-                "Error: loaded Adam optimizer from existing model" +
-                " but optimizer state is empty")
-
     else:
         optim = Optimizer(
             args.optim, args.lr_dec, args.max_grad_norm,
@@ -104,7 +96,8 @@ def build_optim_dec(args, model, checkpoint):
 
     params = [(n, p) for n, p in list(model.named_parameters()) if not n.startswith('bert.model')]
     optim.set_parameters(params)
-
+    if checkpoint is not None:
+        _load_optim_state(args, optim, saved_optimizer_state_dict, params)
 
     return optim
 
@@ -364,7 +357,8 @@ class AbsSummarizer(nn.Module):
         self.decoder_with_graph = TransformerDecoderWithGraph(
             self.args.dec_layers,
             self.args.dec_hidden_size, heads=self.args.dec_heads,
-            d_ff=self.args.dec_ff_size, dropout=self.args.dec_dropout, embeddings=tgt_embeddings)
+            d_ff=self.args.dec_ff_size, dropout=self.args.dec_dropout, embeddings=tgt_embeddings,
+            use_compile=self.args.use_compile)
         self.decoder = TransformerDecoder(
             self.args.dec_layers,
             self.args.dec_hidden_size, heads=self.args.dec_heads,
@@ -29,11 +29,32 @@ def gelu(x):
     return 0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * torch.pow(x, 3))))
 
 
+def additive_mask(mask, dtype=torch.float):
+    """
+    Turns a binary mask (nonzero = masked out) into an additive
+    attention bias of the given dtype.
+    """
+    return torch.zeros(mask.size(), dtype=dtype, device=mask.device) \
+        .masked_fill_(mask.bool(), -1e18)
+
+
 """ Global attention modules (Luong / Bahdanau) """
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+# torch >= 2.0 dispatches this to FlashAttention / memory-efficient kernels.
+_HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
+
+
+def linear_2d(x, weight, bias=None):
+    """
+    `F.linear` on a `[... x dim]` input, flattened to 2-D first so the
+    projection always runs as one addmm rather than a batched matmul.
+    """
+    out = F.linear(x.reshape(-1, x.size(-1)), weight, bias)
+    return out.view(x.shape[:-1] + (-1,))
+
 
 class GlobalAttention(nn.Module):
     """
@@ -287,20 +308,40 @@ class MultiHeadedAttention(nn.Module):
         super(MultiHeadedAttention, self).__init__()
         self.head_count = head_count
 
-        self.linear_keys = nn.Linear(model_dim,
-                                     head_count * self.dim_per_head)
-        self.linear_values = nn.Linear(model_dim,
-                                       head_count * self.dim_per_head)
-        self.linear_query = nn.Linear(model_dim,
-                                      head_count * self.dim_per_head)
+        # Query, key and value projections stacked in that order, so
+        # self-attention runs a single GEMM.
+        self.linear_qkv = nn.Linear(model_dim,
+                                    3 * head_count * self.dim_per_head)
         self.softmax = nn.Softmax(dim=-1)
         self.dropout = nn.Dropout(dropout)
         self.use_final_linear = use_final_linear
         if (self.use_final_linear):
             self.final_linear = nn.Linear(model_dim, model_dim)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints from before the projections were fused store
+        # separate query / key / value linears.
+        names = ['linear_query', 'linear_keys', 'linear_values']
+        for param in ['weight', 'bias']:
+            old_keys = [prefix + name + '.' + param for name in names]
+            if all(k in state_dict for k in old_keys):
+                state_dict[prefix + 'linear_qkv.' + param] = torch.cat(
+                    [state_dict.pop(k) for k in old_keys], 0)
+        super(MultiHeadedAttention, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
+
+    def _project(self, x, start, end):
+        """
+        Apply rows `[start, end)` of the fused projection, counted in
+        units of `model_dim` (0 = query, 1 = key, 2 = value).
+        """
+        start, end = start * self.model_dim, end * self.model_dim
+        return linear_2d(x, self.linear_qkv.weight[start:end],
+                         self.linear_qkv.bias[start:end])
+
     def forward(self, key, value, query, mask=None,
-                layer_cache=None, type=None, predefined_graph_1=None):
+                layer_cache=None, type=None, predefined_graph_1=None,
+                memory_kv=None):
         """
         Compute the context vector and the attention vectors.
 
@@ -312,7 +353,13 @@ class MultiHeadedAttention(nn.Module):
            query (`FloatTensor`): set of `query_len`
                  query vectors  `[batch, query_len, dim]`
            mask: binary mask indicating which keys have
-                 non-zero attention `[batch, query_len, key_len]`
+                 non-zero attention `[batch, query_len, key_len]`,
+                 or an additive float mask of the same shape; masks
+                 with an extra head dim `[batch, 1, query_len or 1,
+                 key_len]` are broadcast as is
+           memory_kv (`(FloatTensor, FloatTensor)`): keys and values
+                 already projected by the caller `[batch, key_len, dim]`;
+                 skips the key/value projections when given
         Returns:
            (`FloatTensor`, `FloatTensor`) :
 
@@ -356,65 +403,49 @@ class MultiHeadedAttention(nn.Module):
         # 1) Project key, value, and query.
         if layer_cache is not None:
             if type == "self":
-                query, key, value = self.linear_query(query), \
-                                    self.linear_keys(query), \
-                                    self.linear_values(query)
+                query, key, value = self._project(query, 0, 3).chunk(3, dim=-1)
 
                 key = shape(key)
                 value = shape(value)
 
-                if layer_cache is not None:
-                    device = key.device
-                    if layer_cache["self_keys"] is not None:
-                        key = torch.cat(
-                            (layer_cache["self_keys"].to(device), key),
-                            dim=2)
-                    if layer_cache["self_values"] is not None:
-                        value = torch.cat(
-                            (layer_cache["self_values"].to(device), value),
-                            dim=2)
-                    layer_cache["self_keys"] = key
-                    layer_cache["self_values"] = value
-            elif type == "context":
-                query = self.linear_query(query)
-                if layer_cache is not None:
-                    if layer_cache["memory_keys"] is None:
-                        key, value = self.linear_keys(key), \
-                                     self.linear_values(value)
-                        key = shape(key)
-                        value = shape(value)
+                device = key.device
+                if layer_cache["self_keys"] is not None:
+                    key = torch.cat(
+                        (layer_cache["self_keys"].to(device), key),
+                        dim=2)
+                if layer_cache["self_values"] is not None:
+                    value = torch.cat(
+                        (layer_cache["self_values"].to(device), value),
+                        dim=2)
+                layer_cache["self_keys"] = key
+                layer_cache["self_values"] = value
+            elif type in ("context", "g_context"):
+                # The memory bank is fixed while decoding, so its keys and
+                # values are projected on the first step only.
+                prefix = "memory" if type == "context" else "g_memory"
+                query = self._project(query, 0, 1)
+                if layer_cache[prefix + "_keys"] is None:
+                    if memory_kv is not None:
+                        key, value = memory_kv
                     else:
-                        key, value = layer_cache["memory_keys"], \
-                                     layer_cache["memory_values"]
-                    layer_cache["memory_keys"] = key
-                    layer_cache["memory_values"] = value
-                else:
-                    key, value = self.linear_keys(key), \
-                                 self.linear_values(value)
-                    key = shape(key)
-                    value = shape(value)
-            elif type == "g_context":
-                query = self.linear_query(query)
-                if layer_cache is not None:
-                    if layer_cache["g_memory_keys"] is None:
-                        key, value = self.linear_keys(key), \
-                                     self.linear_values(value)
-                        key = shape(key)
-                        value = shape(value)
-                    else:
-                        key, value = layer_cache["g_memory_keys"], \
-                                     layer_cache["g_memory_values"]
-                    layer_cache["g_memory_keys"] = key
-                    layer_cache["g_memory_values"] = value
-                else:
-                    key, value = self.linear_keys(key), \
-                                 self.linear_values(value)
-                    key = shape(key)
-                    value = shape(value)
+                        key, value = self._project(key, 1, 3).chunk(2, dim=-1)
+                    layer_cache[prefix + "_keys"] = shape(key)
+                    layer_cache[prefix + "_values"] = shape(value)
+                key = layer_cache[prefix + "_keys"]
+                value = layer_cache[prefix + "_values"]
         else:
-            key = self.linear_keys(key)
-            value = self.linear_values(value)
-            query = self.linear_query(query)
+            if memory_kv is not None:
+                query = self._project(query, 0, 1)
+                key, value = memory_kv
+            elif query is key and key is value:
+                query, key, value = self._project(query, 0, 3).chunk(3, dim=-1)
+            elif key is value:
+                query = self._project(query, 0, 1)
+                key, value = self._project(key, 1, 3).chunk(2, dim=-1)
+            else:
+                query = self._project(query, 0, 1)
+                key = self._project(key, 1, 2)
+                value = self._project(value, 2, 3)
             key = shape(key)
             value = shape(value)
 
@@ -423,13 +454,37 @@ class MultiHeadedAttention(nn.Module):
         key_len = key.size(2)
         query_len = query.size(2)
 
+        if mask is not None and mask.dim() == 3:
+            # Broadcast over heads.
+            mask = mask.unsqueeze(1)
+
+        # 2) Fused attention kernels; incremental decoding keeps the
+        # manual path below.
+        if (_HAS_SDPA and layer_cache is None
+                and predefined_graph_1 is None):
+            if mask is not None:
+                if mask.is_floating_point():
+                    mask = mask.to(query.dtype)
+                else:
+                    # SDPA takes a boolean mask directly, True = attend.
+                    mask = ~mask.bool()
+            context = F.scaled_dot_product_attention(
+                query, key, value, attn_mask=mask,
+                dropout_p=self.dropout.p if self.training else 0.0)
+            if (self.use_final_linear):
+                return linear_2d(unshape(context), self.final_linear.weight,
+                                 self.final_linear.bias)
+            return context
+
         # 2) Calculate and scale scores.
         query = query / math.sqrt(dim_per_head)
         scores = torch.matmul(query, key.transpose(2, 3))
 
         if mask is not None:
-            mask = mask.unsqueeze(1).expand_as(scores)
-            scores = scores.masked_fill(mask, -1e18)
+            if mask.is_floating_point():
+                scores = scores + mask
+            else:
+                scores = scores.masked_fill(mask.bool(), -1e18)
 
         # 3) Apply attention dropout and compute context vectors.
 
@@ -444,7 +499,8 @@ class MultiHeadedAttention(nn.Module):
         drop_attn = self.dropout(attn)
         if (self.use_final_linear):
             context = unshape(torch.matmul(drop_attn, value))
-            output = self.final_linear(context)
+            output = linear_2d(context, self.final_linear.weight,
+                               self.final_linear.bias)
             return output
         else:
             context = torch.matmul(drop_attn, value)
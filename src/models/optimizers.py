@@ -39,9 +39,12 @@ def build_optim(model, opt, checkpoint):
             decay_method=opt.decay_method,
             warmup_steps=opt.warmup_steps)
 
-    optim.set_parameters(model.named_parameters())
+    named_params = list(model.named_parameters())
+    optim.set_parameters(named_params)
 
     if opt.train_from:
+        saved_optimizer_state_dict = remap_fused_qkv_state(
+            saved_optimizer_state_dict, named_params)
         optim.optimizer.load_state_dict(saved_optimizer_state_dict)
         if use_gpu(opt):
             for state in optim.optimizer.state.values():
@@ -57,6 +60,77 @@ def build_optim(model, opt, checkpoint):
     return optim
 
 
+def _cat_states(states):
+    """ Concatenate per-parameter optimizer states along dim 0. """
+    if len(states) == 1:
+        return states[0]
+    merged = {}
+    for k, v in states[0].items():
+        if torch.is_tensor(v) and v.dim() > 0:
+            merged[k] = torch.cat([state[k] for state in states], 0)
+        else:
+            merged[k] = v
+    return merged
+
+
+def remap_fused_qkv_state(state_dict, named_params):
+    """
+    Convert an optimizer `state_dict` saved before the query / key / value
+    projections of `MultiHeadedAttention` were fused into `linear_qkv`.
+
+    `named_params` are the (name, parameter) pairs the new optimizer was
+    built from. The saved `linear_keys`, `linear_values` and
+    `linear_query` states are concatenated in the fused query, key, value
+    order. A state dict already in the fused layout is returned as is.
+    """
+    named_params = [(n, p) for n, p in named_params if p.requires_grad]
+    groups = state_dict['param_groups']
+    old_ids = [i for group in groups for i in group['params']]
+    if len(old_ids) == len(named_params):
+        return state_dict
+
+    error = RuntimeError(
+        "Error: the optimizer state in the checkpoint does not match the"
+        " model parameters; resume with a freshly initialised optimizer")
+    if len(groups) != 1:
+        raise error
+
+    state = state_dict['state']
+    new_state = {}
+    i, j = 0, 0
+    while j < len(named_params):
+        name = named_params[j][0]
+        if name.endswith('linear_qkv.weight'):
+            if i + 6 > len(old_ids) or j + 1 >= len(named_params) \
+                    or not named_params[j + 1][0].endswith('linear_qkv.bias'):
+                raise error
+            # saved as linear_keys, linear_values, linear_query
+            keys_w, keys_b, values_w, values_b, query_w, query_b = old_ids[i:i + 6]
+            parts = [(j, [query_w, keys_w, values_w]),
+                     (j + 1, [query_b, keys_b, values_b])]
+            i, j = i + 6, j + 2
+        else:
+            if i >= len(old_ids):
+                raise error
+            parts = [(j, [old_ids[i]])]
+            i, j = i + 1, j + 1
+        for new_id, ids in parts:
+            if not all(k in state for k in ids):
+                continue
+            param_state = _cat_states([state[k] for k in ids])
+            shape = named_params[new_id][1].shape
+            for v in param_state.values():
+                if torch.is_tensor(v) and v.dim() > 0 and v.shape != shape:
+                    raise error
+            new_state[new_id] = param_state
+    if i != len(old_ids):
+        raise error
+
+    group = dict(groups[0])
+    group['params'] = list(range(len(named_params)))
+    return {'state': new_state, 'param_groups': [group]}
+
+
 class MultipleOptimizer(object):
     """ Implement multiple optimizers needed for sparse adam """
 
@@ -5,6 +5,7 @@ from datetime import datetime
 import time
 import math
 import sys
+import torch
 import wandb
 
 from distributed import all_gather_list
@@ -73,6 +74,7 @@ class ReportMgrBase(object):
             report_stats = Statistics.all_gather_stats(report_stats)
 
         if step % self.report_every == 0:
+            report_stats.materialize()
             self._report_training(
                 step, num_steps, learning_rate, report_stats)
             self.progress_step += 1
@@ -91,6 +93,9 @@ class ReportMgrBase(object):
             valid_stats(Statistics): validation stats
             lr(float): current learning rate
         """
+        for stats in (train_stats, valid_stats):
+            if stats is not None:
+                stats.materialize()
         self._report_step(
             lr, step, train_stats=train_stats, valid_stats=valid_stats)
 
@@ -211,6 +216,8 @@ class Statistics(object):
         """
         # Get a list of world_size lists with len(stat_list) Statistics objects
         our_rank = get_rank()
+        for stat in stat_list:
+            stat.materialize()
         all_stats = all_gather_list(stat_list, max_size=max_size)
 
         our_stats = all_stats[our_rank]
@@ -233,14 +240,28 @@ class Statistics(object):
         """
         self.contra_loss = stat.contra_loss
         self.doc_word_contra_loss = stat.doc_word_contra_loss
-        self.loss += stat.loss
-        self.n_words += stat.n_words
-        self.n_correct += stat.n_correct
+        # Not in place: the fields may be device tensors shared with `stat`.
+        self.loss = self.loss + stat.loss
+        self.n_words = self.n_words + stat.n_words
+        self.n_correct = self.n_correct + stat.n_correct
         self.n_docs += stat.n_docs
 
         if update_n_src_words:
             self.n_src_words += stat.n_src_words
 
+    def materialize(self):
+        """
+        Convert fields accumulated as device tensors to Python numbers.
+        This is the only host sync; call it before reading or sending the
+        statistics.
+        """
+        for name in ['loss', 'n_words', 'n_correct',
+                     'contra_loss', 'doc_word_contra_loss']:
+            value = getattr(self, name)
+            if torch.is_tensor(value):
+                setattr(self, name, value.item())
+        return self
+
     def accuracy(self):
         """ compute accuracy """
         return 100 * (self.n_correct / self.n_words)
@@ -178,7 +178,7 @@ class Trainer(object):
                             break
             train_iter = train_iter_fct()
 
-        return total_stats
+        return total_stats.materialize()
 
     def validate(self, valid_iter, step=0):
         """ Validate model.
@@ -208,6 +208,7 @@ class Trainer(object):
 
                 batch_stats = self.loss.monolithic_compute_loss(batch,outputs,mask_src,node_num)
                 stats.update(batch_stats)
+            stats.materialize()
             self._report_step(0, step, valid_stats=stats)
             return stats
 
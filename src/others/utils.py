@@ -9,10 +9,28 @@ REMAP = {"-lrb-": "(", "-rrb-": ")", "-lcb-": "{", "-rcb-": "}",
          "-lsb-": "[", "-rsb-": "]", "``": '"', "''": '"'}
 
 
+_CLEAN_RE = re.compile(r"-lrb-|-rrb-|-lcb-|-rcb-|-lsb-|-rsb-|``|''")
+
+
 def clean(x):
-    return re.sub(
-        r"-lrb-|-rrb-|-lcb-|-rcb-|-lsb-|-rsb-|``|''",
-        lambda m: REMAP.get(m.group()), x)
+    return _CLEAN_RE.sub(lambda m: REMAP.get(m.group()), x)
+
+
+def clean_tokens(tokens):
+    """
+    Same result as `clean(' '.join(tokens)).split()`, without building and
+    re-splitting the joined string. None of the patterns span a space, so
+    each token can be cleaned on its own.
+    """
+    cleaned = []
+    for token in tokens:
+        if token.isalnum():
+            cleaned.append(token)
+            continue
+        if '-' in token or '`' in token or "'" in token:
+            token = clean(token)
+        cleaned.extend(token.split())
+    return cleaned
 
 
 def process(params):
@@ -1,3 +1,4 @@
+import functools
 import gc
 import glob
 from  tqdm import tqdm
@@ -7,6 +8,7 @@ import scipy.sparse as sp
 import itertools
 import json
 import os
+import pickle
 import random
 import re
 import pandas as pd
@@ -14,9 +16,10 @@ import time
 import dgl
 #from scipy import sparse
 import subprocess
+import threading
 from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join as pjoin
-from nltk.tokenize import sent_tokenize, word_tokenize
 import torch
 from multiprocess import Pool
 from others.tokenization import BertTokenizer
@@ -25,20 +28,106 @@ from others.logging import logger
 from others.tokenization import BertTokenizer
 from pytorch_transformers import XLNetTokenizer
 
-from others.utils import clean
+from others.utils import clean_tokens
 from prepro.utils import _get_word_ngrams
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 import xml.etree.ElementTree as ET
 
 nyt_remove_words = ["photo", "graph", "chart", "map", "table", "drawing"]
+# "(m)", "(s)" and the parenthesised remove words, stripped in one pass
+_NYT_RE = re.compile(r'\((?:' + '|'.join(map(re.escape, ["m", "s"] + nyt_remove_words)) + r')\)')
 
 
 #tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
 model_name = 'microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract'
-tokenizer = AutoTokenizer.from_pretrained(model_name)
+_tokenizer = None
+
+def _get_tokenizer():
+    """The PubMedBERT tokenizer, loaded once per process on first use."""
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = AutoTokenizer.from_pretrained(model_name)
+    return _tokenizer
+
+
+# Neighbour papers recur across many source documents, so their sentences
+# are tokenized once per worker process and then served from this cache.
+@functools.lru_cache(maxsize=200000)
+def _tok_ids(text):
+    tokenizer = _get_tokenizer()
+    return tuple(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text)))
+
+
+def _batch_ids(texts):
+    """Token ids of every text in `texts`, encoded in one batched call."""
+    if len(texts) == 0:
+        return []
+    return _get_tokenizer()(list(texts), add_special_tokens=False)['input_ids']
+
+
+def _join_ids(id_lists, bos, sep, eos):
+    """Concatenate `id_lists` as `bos ids1 sep ids2 ... eos`; `sep` is a list."""
+    ids = [bos]
+    for i, sent_ids in enumerate(id_lists):
+        if i > 0:
+            ids += sep
+        ids += sent_ids
+    ids.append(eos)
+    return ids
+
+
+def _sents_to_ids(sents, cls_vid, sep_vid):
+    """Ids of `[CLS] s1 [SEP] [CLS] s2 ... [SEP]`, built sentence by sentence."""
+    return _join_ids([_tok_ids(' '.join(sent)) for sent in sents],
+                     cls_vid, [sep_vid, cls_vid], sep_vid)
+
+def _segments_and_cls_ids(subtoken_idxs, sep_vid, cls_vid):
+    """
+    Interval segment ids (alternating 0/1 per sentence, each sentence
+    ending at a [SEP]) and the positions of the [CLS] tokens, as compact
+    numpy arrays.
+    """
+    idxs = np.asarray(subtoken_idxs)
+    segs = np.diff(np.flatnonzero(idxs == sep_vid), prepend=-1)
+    segments_ids = np.repeat(np.arange(len(segs)) & 1, segs).astype(np.int8)
+    cls_ids = np.flatnonzero(idxs == cls_vid).astype(np.int32)
+    return segments_ids, cls_ids
+
+def _iter_jsonl(path):
+    """Lazily parse a `.jsonl` file, yielding one record per non-empty line."""
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield _json_loads(line)
+
+def _load_jsonl(path):
+    """Parse a `.jsonl` file into a list of records, one per non-empty line."""
+    return list(_iter_jsonl(path))
+
+def _save_shard(saver, pending, dataset, fpath, max_pending=2):
+    """
+    Save `dataset` to `fpath` on the `saver` thread pool so pickling and
+    I/O overlap with building the next shard. At most `max_pending`
+    shards are kept in memory waiting to be written.
+    """
+    pending.append(saver.submit(torch.save, dataset, fpath,
+                                pickle_protocol=pickle.HIGHEST_PROTOCOL))
+    while len(pending) > max_pending:
+        pending.pop(0).result()
+
+_CORENLP_QUOTE_RE = re.compile(r' \'{\w}')
+_CORENLP_DQUOTE_RE = re.compile(r'\'\' {\w}')
+
 def recover_from_corenlp(s):
-    s = re.sub(r' \'{\w}', '\'\g<1>', s)
-    s = re.sub(r'\'\' {\w}', '\'\'\g<1>', s)
+    s = _CORENLP_QUOTE_RE.sub('\'\g<1>', s)
+    s = _CORENLP_DQUOTE_RE.sub('\'\'\g<1>', s)
+    return s
 
 
 
@@ -46,7 +135,9 @@ def load_json(p, lower):
     source = []
     tgt = []
     flag = False
-    for sent in json.load(open(p))['sentences']:
+    with open(p, 'rb') as f:
+        sentences = _json_loads(f.read())['sentences']
+    for sent in sentences:
         tokens = [t['word'] for t in sent['tokens']]
         if (lower):
             tokens = [t.lower() for t in tokens]
@@ -59,12 +150,17 @@ def load_json(p, lower):
         else:
             source.append(tokens)
 
-    source = [clean(' '.join(sent)).split() for sent in source]
-    tgt = [clean(' '.join(sent)).split() for sent in tgt]
+    source = [clean_tokens(sent) for sent in source]
+    tgt = [clean_tokens(sent) for sent in tgt]
     return source, tgt
 
 
 
+def _first_text_tokens(node, tag):
+    """Lower-cased tokens of the first `tag` element under `node`."""
+    return next(node.iter(tag)).text.lower().split()
+
+
 def load_xml(p):
     tree = ET.parse(p)
     root = tree.getroot()
@@ -72,7 +168,7 @@ def load_xml(p):
     title_node = list(root.iter('hedline'))
     if (len(title_node) > 0):
         try:
-            title = [p.text.lower().split() for p in list(title_node[0].iter('hl1'))][0]
+            title = _first_text_tokens(title_node[0], 'hl1')
         except:
             print(p)
 
@@ -85,18 +181,14 @@ def load_xml(p):
     abs_node = list(root.iter('abstract'))
     if (len(abs_node) > 0):
         try:
-            abs = [p.text.lower().split() for p in list(abs_node[0].iter('p'))][0]
+            abs = _first_text_tokens(abs_node[0], 'p')
         except:
             print(p)
 
     else:
         return None, None
     abs = ' '.join(abs).split(';')
-    abs[-1] = abs[-1].replace('(m)', '')
-    abs[-1] = abs[-1].replace('(s)', '')
-
-    for ww in nyt_remove_words:
-        abs[-1] = abs[-1].replace('(' + ww + ')', '')
+    abs[-1] = _NYT_RE.sub('', abs[-1])
     abs = [p.split() for p in abs]
     abs = [p for p in abs if len(p) > 2]
 
@@ -163,70 +255,74 @@ def tokenize(args):
     print("Successfully finished tokenizing %s to %s.\n" % (stories_dir, tokenized_stories_dir))
 
 
-def generate_graph_structs(args, paper_id, graph_strut_dict):
+def _references_map(graph_strut_dict):
+    """Each paper's references, restricted to papers in `graph_strut_dict`."""
+    return {pid: tuple(ref for ref in paper['references'] if ref in graph_strut_dict)
+            for pid, paper in graph_strut_dict.items()}
+
+
+def generate_graph_structs(args, paper_id, refs_map):
     sub_graph_dict = {}
-    sub_graph_set = []
 
     n_hop = args.n_hop
     max_neighbor_num = args.max_neighbor_num
-    k_nbrs = _k_hop_neighbor(paper_id, n_hop, max_neighbor_num, graph_strut_dict)
-    for sub_g in k_nbrs:
-        sub_graph_set += sub_g
-
-    for node in sub_graph_set:
-        sub_graph_dict[node] = []
-
+    k_nbrs = _k_hop_neighbor(paper_id, n_hop, max_neighbor_num, refs_map)
     for sub_g in k_nbrs:
-        for centre_node in sub_g:
-            nbrs = graph_strut_dict[centre_node]['references']
-            c_nbrs = list(set(nbrs).intersection(sub_graph_set))
-            sub_graph_dict[centre_node].extend(c_nbrs)
-            for c_nbr in c_nbrs:
-                sub_graph_dict[c_nbr].append(centre_node)
+        for node in sub_g:
+            sub_graph_dict[node] = []
+    # dict keys double as an ordered set of the subgraph nodes.
+    for centre_node in sub_graph_dict:
+        # de-duplicate while keeping the reference order
+        c_nbrs = [nbr for nbr in dict.fromkeys(refs_map[centre_node]) if nbr in sub_graph_dict]
+        sub_graph_dict[centre_node].extend(c_nbrs)
+        for c_nbr in c_nbrs:
+            sub_graph_dict[c_nbr].append(centre_node)
     # in python 3.6, the first in subgraph dict is source paper
     return sub_graph_dict
 
-def _k_hop_neighbor(paper_id, n_hop, max_neighbor, graph_strut_dict):
+def _k_hop_neighbor(paper_id, n_hop, max_neighbor, refs_map):
     sub_graph = [[] for _ in range(n_hop + 1)]
     level = 0
     visited = set()
     q = deque()
-    q.append([paper_id, level])
+    q.append((paper_id, level))
+    visited.add(paper_id)
+    # At most max_neighbor + 1 nodes are ever taken from the queue, and
+    # nodes past n_hop are never kept, so nothing beyond that is enqueued.
+    max_queued = max_neighbor + 1
     curr_node_num = 0
     while len(q) != 0:
         paper_first = q.popleft()
         paper_id_first, level_first = paper_first
-        if level_first > n_hop:
-            return sub_graph
         sub_graph[level_first].append(paper_id_first)
         curr_node_num += 1
         if curr_node_num > max_neighbor:
             return sub_graph
-        visited.add(paper_id_first)
-        for pid in graph_strut_dict[paper_id_first]["references"]:
-            if pid not in visited and pid in graph_strut_dict:
-                q.append([pid, level_first + 1])
+        if level_first == n_hop or len(visited) >= max_queued:
+            continue
+        for pid in refs_map[paper_id_first]:
+            if pid not in visited:
+                q.append((pid, level_first + 1))
                 visited.add(pid)
+                if len(visited) >= max_queued:
+                    break
 
     return sub_graph
 
 def generate_dgl_graph(args, paper_id, graph_struct, nodes_num):
-    g = dgl.DGLGraph()
     assert len(graph_struct) == nodes_num
 
-    g.add_nodes(len(graph_struct))
     #print('g:', graph_struct)
-    pid2idx = {}
-    for index, key_node in enumerate(graph_struct):
-        pid2idx[key_node] = index
+    pid2idx = {key_node: index for index, key_node in enumerate(graph_struct)}
     assert pid2idx[paper_id] == 0
     #print('id:',pid2idx)
-    for index, key_node in enumerate(graph_struct):
-        neighbor = [pid2idx[node] for node in graph_struct[key_node]]
-        # add self loop
-        neighbor.append(index)
-        key_nodes = [index] * len(neighbor)
-        g.add_edges(key_nodes, neighbor)
+    # All edges are collected first and the graph is built in one call.
+    u = [pid2idx[key_node] for key_node in graph_struct for _ in graph_struct[key_node]]
+    v = [pid2idx[node] for key_node in graph_struct for node in graph_struct[key_node]]
+    g = dgl.graph((torch.tensor(u, dtype=torch.long), torch.tensor(v, dtype=torch.long)),
+                  num_nodes=nodes_num)
+    # add self loop
+    g = dgl.add_self_loop(g)
     adj = g.adjacency_matrix_scipy(return_edge_ids=False).astype(float)
     adj= preprocess_adj(adj).todense()
     #print(adj)
@@ -238,6 +334,21 @@ def generate_dgl_graph(args, paper_id, graph_struct, nodes_num):
     #print(adj)
     return adj
 
+def _split_sents(text):
+    """
+    Split raw text on '.' into token sentences, each ending in '.'.
+    Returned as tuples so results can be shared from a cache.
+    """
+    return tuple(tuple((each_s + " .").split()) for each_s in text.split(".") if each_s)
+
+@functools.lru_cache(maxsize=4096)
+def _split_neighbour_text(text):
+    """
+    `_split_sents` for neighbour full texts, which recur across source
+    papers. Cleared after each corpus by `format_cite`.
+    """
+    return _split_sents(text)
+
 def generate_graph_inputs(args, graph_struct, graph_strut_dict, abstract, pid_inp):
     graph_inputs = []
     temp_neigh = []
@@ -255,9 +366,7 @@ def generate_graph_inputs(args, graph_struct, graph_strut_dict, abstract, pid_in
     #print(graph_struct[pid_inp])
     for pid in graph_struct[pid_inp]:
         #print(pid)
-        graph_i = graph_strut_dict[pid]["full_text"]
-        each_in = graph_i.split(".")
-        graph_input = [(each_s + " .").split() for each_s in each_in if each_s]
+        graph_input = _split_neighbour_text(graph_strut_dict[pid]["full_text"])
         #print(graph_input)
         graph_inputs.append(graph_input)
     
@@ -265,9 +374,7 @@ def generate_graph_inputs(args, graph_struct, graph_strut_dict, abstract, pid_in
     neg_graph_inputs = []
     if graph_inputs !=[]:
         for pid in neg_pid:
-            graph_i = graph_strut_dict[pid]["abstract"]
-            abs_list = graph_i.split(".")
-            abstr = [(each_s + " .").split() for each_s in abs_list if each_s]
+            abstr = _split_sents(graph_strut_dict[pid]["abstract"])
             #print("abs:", abstr)
             neg_graph_inputs.append(abstr)
 
@@ -285,8 +392,7 @@ def generate_graph_inputs(args, graph_struct, graph_strut_dict, abstract, pid_in
                 print("r_score:", r_score)
                 print("references:", [[" ".join(s) for s in sent] for sent in graph_inp])
                 graph_i = graph_strut_dict[graph_struct[pid_inp][del_count]]["abstract"]
-                abs_list = graph_i.split(".")
-                abstr = [(each_s + " .").split() for each_s in abs_list if each_s]
+                abstr = _split_sents(graph_i)
                 _, a_score = greedy_selection(abstr, abstract, 8)
                 print("a_score:", a_score)
                 print("abstract_referece:", graph_i)
@@ -352,14 +458,9 @@ def format_cite(args):
         graph_strut_dict = {}
         for dir in dirs:
             source_txt_file = os.path.join(root_data_dir, '{}_updated.jsonl'.format(dir))
-            #df = pd.read_json(path_or_buf=source_txt_file, lines=True)
-            
-            with open(source_txt_file, 'r') as f:
-                json_main = list(f)
-            
-            for ins in json_main:
-                ins = json.loads(ins)
+            for ins in _load_jsonl(source_txt_file):
                 graph_strut_dict[ins["pmid"]] = ins
+        refs_map = _references_map(graph_strut_dict)
     else:
         graph_train_dict = {}
         graph_val_dict = {}
@@ -370,100 +471,54 @@ def format_cite(args):
         val_path = os.path.join(root_data_dir, 'val_updated.jsonl')
         train_path = os.path.join(root_data_dir, 'train_updated.jsonl')
 
-        #train_df = pd.read_json(path_or_buf=train_path, lines=True)
-        #val_df = pd.read_json(path_or_buf=val_path, lines=True)
-        #test_df = pd.read_json(path_or_buf=test_path, lines=True)
-
-        with open(train_path, 'r') as f:
-            train_json_main = list(f)
-
-        with open(val_path, 'r') as f:
-            val_json_main = list(f)
-        
-        with open(test_path, 'r') as f:
-            test_json_main = list(f)
-        
-        for ins in train_json_main:
-            ins = json.loads(ins)
-            #print(ins)
+        for ins in _load_jsonl(train_path):
             graph_train_dict[ins["pmid"]] = ins
 
-        for ins in val_json_main:
-            ins = json.loads(ins)
+        for ins in _load_jsonl(val_path):
             graph_val_dict[ins["pmid"]] = ins
 
-        for ins in test_json_main:
-            ins = json.loads(ins)
+        for ins in _load_jsonl(test_path):
             graph_test_dict[ins["pmid"]] = ins
 
         graph = {'train': graph_train_dict, 'val': graph_val_dict, 'test': graph_test_dict}
+        refs_map = {corpus: _references_map(g) for corpus, g in graph.items()}
 
-    data_dict = {}
-
-    scores = []
-    abs_scores = []
-    for corpus in dirs:
-        data_lst = []
-        source_txt_file = os.path.join(root_data_dir, '{}_updated.jsonl'.format(corpus))
-        #df = pd.read_json(path_or_buf=source_txt_file, lines=True)
-
-        with open(source_txt_file, 'r') as f:
-            json_main = list(f)
-
-        #for row in tqdm(json_main):
-        for row in tqdm(json_main):
-            row = json.loads(row)
-            pid = row['pmid']
-
-            intro = row['full_text'].split(".")
-            introduction = [(each_s+" .").split() for each_s in intro if each_s]
-            abstract = row['abstract']
-            print("abstract:", abstract)
-            abs_list = abstract.split(".")
-            abstr = [(each_s+" .").split() for each_s in abs_list if each_s]
-            if args.setting == "transductive":
-                if corpus == "train":
-                    sub_graph_dict = generate_graph_structs(args, pid, graph_strut_dict)
-                    graph_text, neg_graph_text, sub_graph_dict = generate_graph_inputs(args, sub_graph_dict, graph_strut_dict, introduction[10:40], pid)
-                else:
-                    sub_graph_dict = generate_graph_structs(args, pid, graph_strut_dict)
-                    graph_text, neg_graph_text, sub_graph_dict = generate_graph_inputs(args, sub_graph_dict, graph_strut_dict, introduction[10:40], pid)
-            else:
-                if corpus == "train":
-                    sub_graph_dict = generate_graph_structs(args, pid, graph[corpus])
-                    graph_text, neg_graph_text, sub_graph_dict  = generate_graph_inputs(args, sub_graph_dict, graph[corpus], abstr, pid)
-                else:
-                    sub_graph_dict = generate_graph_structs(args, pid, graph[corpus])
-                    graph_text, neg_graph_text, sub_graph_dict  = generate_graph_inputs(args, sub_graph_dict, graph[corpus], abstr, pid)
-
-            node_num = len(graph_text) + 1
-            data_lst.append((corpus, pid, abstr, introduction, sub_graph_dict, graph_text, neg_graph_text, node_num, args))
-        data_dict[corpus] = data_lst
-
+    saver = ThreadPoolExecutor(max_workers=2)
+    pending = []
+    chunksize = 8
     for d in dirs:
-        a_lst = data_dict[d]
+        source_txt_file = os.path.join(root_data_dir, '{}_updated.jsonl'.format(d))
+        if args.setting == "transductive":
+            corpus_graph, corpus_refs = graph_strut_dict, refs_map
+        else:
+            corpus_graph, corpus_refs = graph[d], refs_map[d]
+        # the pool's task thread drains its input eagerly; `slots` caps the
+        # number of rows built but not yet returned by a worker
+        slots = threading.BoundedSemaphore(4 * chunksize * args.n_cpus)
+        rows = _cite_inputs(args, d, source_txt_file, corpus_graph, corpus_refs, slots)
         pool = Pool(args.n_cpus)
         dataset = []
         shard_count = 0
-        with tqdm(total=len(a_lst)) as pbar:
+        with tqdm() as pbar:
             with tqdm(total=args.shard_size) as spbar:
-                for i, data in enumerate(pool.imap(_format_cite, a_lst)):
+                for i, data in enumerate(pool.imap_unordered(_format_cite, rows, chunksize=chunksize)):
+                    slots.release()
                     if data:
                         src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt, \
-                        graph_subtoken_idxs, neg_graph_subtoken_idxs, graph = data
+                        graph_subtoken_idxs, neg_graph_subtoken_idxs, graph_struct = data
                         
                         #print("graph_idxs:", graph_subtoken_idxs)
-                        #print("graph:", graph)
+                        #print("graph:", graph_struct)
                         #print("len:", len(graph_subtoken_idxs))
                         b_data_dict = {"src": src_subtoken_idxs, "tgt": tgt_subtoken_idxs,
                                        "src_sent_labels": sent_labels, "segs": segments_ids, 'clss': cls_ids,
                                        'src_txt': src_txt, "tgt_txt": tgt_txt, 'graph_src':graph_subtoken_idxs,
-                                       'neg_graph_src':neg_graph_subtoken_idxs, "graph": graph}
+                                       'neg_graph_src':neg_graph_subtoken_idxs, "graph": graph_struct}
                         dataset.append(b_data_dict)
                     spbar.update()
                     if (len(dataset) > args.shard_size):
                         fpath = "{:s}/{:s}.{:d}.pt".format(args.save_path, d, shard_count)
-                        torch.save(dataset,fpath)
+                        _save_shard(saver, pending, dataset, fpath)
                         dataset = []
                         shard_count += 1
                         pbar.update()
@@ -473,12 +528,42 @@ def format_cite(args):
                 pbar.close()
             pool.close()
             pool.join()
+            _split_neighbour_text.cache_clear()
             if len(dataset) > 0:
                 fpath = "{:s}/{:s}.{:d}.pt".format(args.save_path, d, shard_count)
-                torch.save(dataset,fpath)
+                _save_shard(saver, pending, dataset, fpath)
                 shard_count += 1
         #end = time.time()
         #print('... Ending (4), time elapsed {}'.format(end - start))
+    for future in pending:
+        future.result()
+    saver.shutdown()
+
+
+def _cite_inputs(args, corpus, source_txt_file, graph_strut_dict, refs_map, slots):
+    """
+    Lazily build the `_format_cite` inputs of `corpus`, one row of
+    `source_txt_file` at a time. A slot is taken from `slots` before each
+    row is yielded and must be released once its result is consumed.
+    """
+    for row in _iter_jsonl(source_txt_file):
+        pid = row['pmid']
+
+        intro = row['full_text'].split(".")
+        introduction = [(each_s+" .").split() for each_s in intro if each_s]
+        abstract = row['abstract']
+        print("abstract:", abstract)
+        abs_list = abstract.split(".")
+        abstr = [(each_s+" .").split() for each_s in abs_list if each_s]
+        sub_graph_dict = generate_graph_structs(args, pid, refs_map)
+        if args.setting == "transductive":
+            graph_text, neg_graph_text, sub_graph_dict = generate_graph_inputs(args, sub_graph_dict, graph_strut_dict, introduction[10:40], pid)
+        else:
+            graph_text, neg_graph_text, sub_graph_dict = generate_graph_inputs(args, sub_graph_dict, graph_strut_dict, abstr, pid)
+
+        node_num = len(graph_text) + 1
+        slots.acquire()
+        yield (corpus, pid, abstr, introduction, sub_graph_dict, graph_text, neg_graph_text, node_num, args)
 
 
 def format_calculate_abs(args):
@@ -491,14 +576,9 @@ def format_calculate_abs(args):
         graph_strut_dict = {}
         for dir in dirs:
             source_txt_file = os.path.join(root_data_dir, '{}.jsonl'.format(dir))
-            # df = pd.read_json(path_or_buf=source_txt_file, lines=True)
-
-            with open(source_txt_file, 'r') as f:
-                json_main = list(f)
-
-            for ins in json_main:
-                ins = json.loads(ins)
+            for ins in _load_jsonl(source_txt_file):
                 graph_strut_dict[ins["paper_id"]] = ins
+        refs_map = _references_map(graph_strut_dict)
     else:
         graph_train_dict = {}
         graph_val_dict = {}
@@ -508,45 +588,24 @@ def format_calculate_abs(args):
         val_path = os.path.join(root_data_dir, 'val.jsonl')
         train_path = os.path.join(root_data_dir, 'train.jsonl')
 
-        # train_df = pd.read_json(path_or_buf=train_path, lines=True)
-        # val_df = pd.read_json(path_or_buf=val_path, lines=True)
-        # test_df = pd.read_json(path_or_buf=test_path, lines=True)
-
-        with open(train_path, 'r') as f:
-            train_json_main = list(f)
-
-        with open(val_path, 'r') as f:
-            val_json_main = list(f)
-
-        with open(test_path, 'r') as f:
-            test_json_main = list(f)
-
-        for ins in train_json_main:
-            ins = json.loads(ins)
+        for ins in _load_jsonl(train_path):
             graph_train_dict[ins["paper_id"]] = ins
 
-        for ins in val_json_main:
-            ins = json.loads(ins)
+        for ins in _load_jsonl(val_path):
             graph_val_dict[ins["paper_id"]] = ins
 
-        for ins in test_json_main:
-            ins = json.loads(ins)
+        for ins in _load_jsonl(test_path):
             graph_test_dict[ins["paper_id"]] = ins
 
         graph = {'train': graph_train_dict, 'val': graph_val_dict, 'test': graph_test_dict}
+        refs_map = {corpus: _references_map(g) for corpus, g in graph.items()}
 
     scores_1 = []
     scores_2 = []
     for corpus in dirs:
         data_lst = []
         source_txt_file = os.path.join(root_data_dir, '{}.jsonl'.format(corpus))
-        # df = pd.read_json(path_or_buf=source_txt_file, lines=True)
-
-        with open(source_txt_file, 'r') as f:
-            json_main = list(f)
-
-        for row in tqdm(json_main):
-            row = json.loads(row)
+        for row in tqdm(_load_jsonl(source_txt_file)):
             pid = row['paper_id']
             introduction = []
             for sub in row['introduction']:
@@ -560,18 +619,18 @@ def format_calculate_abs(args):
             # print(abstr)
             if args.setting == "transductive":
                 if corpus == "train":
-                    sub_graph_dict = generate_graph_structs(args, pid, graph_strut_dict)
+                    sub_graph_dict = generate_graph_structs(args, pid, refs_map)
                     score_list_1, score_list_2 = generate_graph_inputs_abs(args, sub_graph_dict, graph_strut_dict, abstr)
                 else:
-                    sub_graph_dict = generate_graph_structs(args, pid, graph_strut_dict)
+                    sub_graph_dict = generate_graph_structs(args, pid, refs_map)
                     score_list_1, score_list_2 = generate_graph_inputs_abs(args, sub_graph_dict, graph_strut_dict, abstr)
             else:
                 #print("abstr:", abstract)
                 if corpus == "train":
-                    sub_graph_dict = generate_graph_structs(args, pid, graph[corpus])
+                    sub_graph_dict = generate_graph_structs(args, pid, refs_map[corpus])
                     score_list_1, score_list_2 = generate_graph_inputs_abs(args, sub_graph_dict, graph[corpus], abstr)
                 else:
-                    sub_graph_dict = generate_graph_structs(args, pid, graph[corpus])
+                    sub_graph_dict = generate_graph_structs(args, pid, refs_map[corpus])
                     score_list_1, score_list_2 = generate_graph_inputs_abs(args, sub_graph_dict, graph[corpus], abstr)
             if score_list_1 != []:
                 scores_1 += score_list_1
@@ -590,13 +649,17 @@ def _format_cite(params):
                              is_test=is_test)
     return b_data
 
-def cal_rouge(evaluated_ngrams, reference_ngrams):
-    reference_count = len(reference_ngrams)
-    evaluated_count = len(evaluated_ngrams)
+_ROUGE_KEEP = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 ')
+_ROUGE_DELETE = str.maketrans('', '', ''.join(chr(c) for c in range(128) if chr(c) not in _ROUGE_KEEP))
+_ROUGE_CLEAN_RE = re.compile(r'[^a-zA-Z0-9 ]')
 
-    overlapping_ngrams = evaluated_ngrams.intersection(reference_ngrams)
-    overlapping_count = len(overlapping_ngrams)
+def _rouge_clean(s):
+    """Keep only ASCII letters, digits and spaces."""
+    # The translate table drops the ASCII junk in one pass; the regex then
+    # only has non-ASCII characters left to remove.
+    return _ROUGE_CLEAN_RE.sub('', s.translate(_ROUGE_DELETE))
 
+def _rouge_prf(overlapping_count, evaluated_count, reference_count):
     if evaluated_count == 0:
         precision = 0.0
     else:
@@ -608,36 +671,49 @@ def cal_rouge(evaluated_ngrams, reference_ngrams):
         recall = overlapping_count / reference_count
 
     f1_score = 2.0 * ((precision * recall) / (precision + recall + 1e-8))
+    return f1_score, precision, recall
+
+
+def cal_rouge(evaluated_ngrams, reference_ngrams):
+    reference_count = len(reference_ngrams)
+    evaluated_count = len(evaluated_ngrams)
+
+    overlapping_ngrams = evaluated_ngrams.intersection(reference_ngrams)
+    overlapping_count = len(overlapping_ngrams)
+
+    f1_score, precision, recall = _rouge_prf(overlapping_count, evaluated_count, reference_count)
     return {"f": f1_score, "p": precision, "r": recall}
 
 
 def greedy_selection(doc_sent_list, abstract_sent_list, summary_size):
-    def _rouge_clean(s):
-        return re.sub(r'[^a-zA-Z0-9 ]', '', s)
-
     max_rouge = 0.0
     abstract = sum(abstract_sent_list, [])
     abstract = _rouge_clean(' '.join(abstract)).split()
     sents = [_rouge_clean(' '.join(s)).split() for s in doc_sent_list]
-    evaluated_1grams = [_get_word_ngrams(1, [sent]) for sent in sents]
-    reference_1grams = _get_word_ngrams(1, [abstract])
-    evaluated_2grams = [_get_word_ngrams(2, [sent]) for sent in sents]
-    reference_2grams = _get_word_ngrams(2, [abstract])
+    # Unigrams as bare tokens and bigrams as zipped pairs; only overlap
+    # counts matter, so they need not be the tuples `_get_word_ngrams` makes.
+    evaluated_1grams = [frozenset(sent) for sent in sents]
+    reference_1grams = frozenset(abstract)
+    evaluated_2grams = [frozenset(zip(sent, sent[1:])) for sent in sents]
+    reference_2grams = frozenset(zip(abstract, abstract[1:]))
+    ref_1len = len(reference_1grams)
+    ref_2len = len(reference_2grams)
 
     selected = []
+    # n-grams of the sentences selected so far
+    sel_1grams = frozenset()
+    sel_2grams = frozenset()
     for s in range(summary_size):
         cur_max_rouge = max_rouge
         cur_id = -1
         for i in range(len(sents)):
             if (i in selected):
                 continue
-            c = selected + [i]
-            candidates_1 = [evaluated_1grams[idx] for idx in c]
-            candidates_1 = set.union(*map(set, candidates_1))
-            candidates_2 = [evaluated_2grams[idx] for idx in c]
-            candidates_2 = set.union(*map(set, candidates_2))
-            rouge_1 = cal_rouge(candidates_1, reference_1grams)['f']
-            rouge_2 = cal_rouge(candidates_2, reference_2grams)['f']
+            candidates_1 = sel_1grams | evaluated_1grams[i]
+            candidates_2 = sel_2grams | evaluated_2grams[i]
+            # Same arithmetic as cal_rouge, so ties break identically.
+            rouge_1 = _rouge_prf(len(candidates_1 & reference_1grams), len(candidates_1), ref_1len)[0]
+            rouge_2 = _rouge_prf(len(candidates_2 & reference_2grams), len(candidates_2), ref_2len)[0]
             rouge_score = rouge_1 + rouge_2
             if rouge_score > cur_max_rouge:
                 cur_max_rouge = rouge_score
@@ -645,15 +721,14 @@ def greedy_selection(doc_sent_list, abstract_sent_list, summary_size):
         if (cur_id == -1):
             return selected, cur_max_rouge
         selected.append(cur_id)
+        sel_1grams = sel_1grams | evaluated_1grams[cur_id]
+        sel_2grams = sel_2grams | evaluated_2grams[cur_id]
         max_rouge = cur_max_rouge
    
     #print("max:", cur_max_rouge)
     return sorted(selected), max_rouge
 
 def cal_score(doc_sent_list, abstract_sent_list):
-    def _rouge_clean(s):
-        return re.sub(r'[^a-zA-Z0-9 ]', '', s)
-
     abstract = sum(abstract_sent_list, [])
     abstract = _rouge_clean(' '.join(abstract)).split()
     doc = sum(doc_sent_list, [])
@@ -677,10 +752,20 @@ def hashhex(s):
     return h.hexdigest()
 
 
+_bert_base_tokenizer = None
+
+def _get_bert_base_tokenizer():
+    """The bert-base-uncased tokenizer, loaded once per process on first use."""
+    global _bert_base_tokenizer
+    if _bert_base_tokenizer is None:
+        _bert_base_tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
+    return _bert_base_tokenizer
+
+
 class BertData():
     def __init__(self, args):
         self.args = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
+        self.tokenizer = _get_bert_base_tokenizer()
 
         self.sep_token = '[SEP]'
         self.cls_token = '[CLS]'
@@ -720,20 +805,15 @@ class BertData():
 
         src_subtokens = [self.cls_token] + src_subtokens + [self.sep_token]
         src_subtoken_idxs = self.tokenizer.convert_tokens_to_ids(src_subtokens)
-        _segs = [-1] + [i for i, t in enumerate(src_subtoken_idxs) if t == self.sep_vid]
-        segs = [_segs[i] - _segs[i - 1] for i in range(1, len(_segs))]
-        segments_ids = []
-        for i, s in enumerate(segs):
-            if (i % 2 == 0):
-                segments_ids += s * [0]
-            else:
-                segments_ids += s * [1]
-        cls_ids = [i for i, t in enumerate(src_subtoken_idxs) if t == self.cls_vid]
+        segments_ids, cls_ids = _segments_and_cls_ids(src_subtoken_idxs, self.sep_vid, self.cls_vid)
         sent_labels = sent_labels[:len(cls_ids)]
 
-        tgt_subtokens_str = '[unused0] ' + ' [unused2] '.join(
-            [' '.join(self.tokenizer.tokenize(' '.join(tt), use_bert_basic_tokenizer=use_bert_basic_tokenizer)) for tt in tgt]) + ' [unused1]'
-        tgt_subtoken = tgt_subtokens_str.split()[:self.args.max_tgt_ntokens]
+        # The markers are whole vocab entries (and in never_split), so they
+        # pass through one tokenize call over the full target unchanged.
+        tgt_text = '{} {} {}'.format(self.tgt_bos, ' {} '.format(self.tgt_sent_split).join(
+            [' '.join(tt) for tt in tgt]), self.tgt_eos)
+        tgt_subtoken = self.tokenizer.tokenize(
+            tgt_text, use_bert_basic_tokenizer=use_bert_basic_tokenizer)[:self.args.max_tgt_ntokens]
         if ((not is_test) and len(tgt_subtoken) < self.args.min_tgt_ntokens):
             return None
 
@@ -742,6 +822,7 @@ class BertData():
         tgt_txt = '<q>'.join([' '.join(tt) for tt in tgt])
         src_txt = [original_src_txt[i] for i in idxs]
 
+        src_subtoken_idxs = np.asarray(src_subtoken_idxs, dtype=np.int32)
         return src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt
 
 class BertCiteData():
@@ -755,9 +836,12 @@ class BertCiteData():
         self.tgt_bos = '[unused0]'
         self.tgt_eos = '[unused1]'
         self.tgt_sent_split = '[unused2]'
+        tokenizer = _get_tokenizer()
         self.sep_vid = tokenizer.vocab[self.sep_token]
         self.cls_vid = tokenizer.vocab[self.cls_token]
         self.pad_vid = tokenizer.vocab[self.pad_token]
+        self.tgt_bos_vid, self.tgt_eos_vid, self.tgt_sent_split_vid = tokenizer.convert_tokens_to_ids(
+            [self.tgt_bos, self.tgt_eos, self.tgt_sent_split])
 
     def preprocess(self, src, tgt, sent_labels, graph_src, neg_graph_src, graph, use_bert_basic_tokenizer=False, is_test=False):
 
@@ -782,60 +866,35 @@ class BertCiteData():
             return None
 
         src_txt = [' '.join(sent) for sent in src]
-        text = ' {} {} '.format(self.sep_token, self.cls_token).join(src_txt)
         graph_subtoken_idxs = []
         neg_graph_subtoken_idxs=[]
         if graph_src != []:
             for each_graph_srcs in graph_src:
-                subtoken_idxs = []
-                #print("each_graph:", each_graph_srcs)
-                #for each_graph_src in each_graph_srcs:
-                each_src = [' '.join(sent) for sent in each_graph_srcs]
-                each_text = ' {} {} '.format(self.sep_token, self.cls_token).join(each_src)
-                each_graph_src_subtokens = tokenizer.tokenize(each_text)
-                each_graph_src_subtokens = [self.cls_token] + each_graph_src_subtokens + [self.sep_token]
-                each_graph_subtoken_idxs = tokenizer.convert_tokens_to_ids(each_graph_src_subtokens)
-                #subtoken_idxs.append(each_graph_subtoken_idxs)
-                #print(each_graph_subtoken_idxs)
-                graph_subtoken_idxs.append(each_graph_subtoken_idxs)
+                graph_subtoken_idxs.append(
+                    _sents_to_ids(each_graph_srcs, self.cls_vid, self.sep_vid))
 
             for each_graph_srcs in neg_graph_src:
-                #subtoken_idxs = []
-                #for each_graph_src in each_graph_srcs:
-                each_src = [' '.join(sent) for sent in each_graph_srcs]
-                each_text = ' {} {} '.format(self.sep_token, self.cls_token).join(each_src)
-                each_graph_src_subtokens = tokenizer.tokenize(each_text)
-                each_graph_src_subtokens = [self.cls_token] + each_graph_src_subtokens + [self.sep_token]
-                each_graph_subtoken_idxs = tokenizer.convert_tokens_to_ids(each_graph_src_subtokens)
-                #subtoken_idxs.append(each_graph_subtoken_idxs)
-                neg_graph_subtoken_idxs.append(each_graph_subtoken_idxs)
+                neg_graph_subtoken_idxs.append(
+                    _sents_to_ids(each_graph_srcs, self.cls_vid, self.sep_vid))
 
         #print(graph_subtoken_idxs)
-        src_subtokens = tokenizer.tokenize(text)
-        src_subtokens = [self.cls_token] + src_subtokens + [self.sep_token]
-        src_subtoken_idxs = tokenizer.convert_tokens_to_ids(src_subtokens)
-        _segs = [-1] + [i for i, t in enumerate(src_subtoken_idxs) if t == self.sep_vid]
-        segs = [_segs[i] - _segs[i - 1] for i in range(1, len(_segs))]
-        segments_ids = []
-        for i, s in enumerate(segs):
-            if (i % 2 == 0):
-                segments_ids += s * [0]
-            else:
-                segments_ids += s * [1]
-        cls_ids = [i for i, t in enumerate(src_subtoken_idxs) if t == self.cls_vid]
+        # Sentences are encoded in one batch by the Rust tokenizer and the
+        # [CLS]/[SEP] ids spliced in, which matches tokenizing `text`.
+        src_subtoken_idxs = _join_ids(_batch_ids(src_txt),
+                                      self.cls_vid, [self.sep_vid, self.cls_vid], self.sep_vid)
+        segments_ids, cls_ids = _segments_and_cls_ids(src_subtoken_idxs, self.sep_vid, self.cls_vid)
         sent_labels = sent_labels[:len(cls_ids)]
 
-        tgt_subtokens_str = '[unused0] ' + ' [unused2] '.join(
-            [' '.join(tokenizer.tokenize(' '.join(tt), use_bert_basic_tokenizer=use_bert_basic_tokenizer)) for tt in tgt]) + ' [unused1]'
-        tgt_subtoken = tgt_subtokens_str.split()[:self.args.max_tgt_ntokens]
-        if ((not is_test) and len(tgt_subtoken) < self.args.min_tgt_ntokens):
+        tgt_subtoken_idxs = _join_ids(_batch_ids([' '.join(tt) for tt in tgt]),
+                                      self.tgt_bos_vid, [self.tgt_sent_split_vid], self.tgt_eos_vid)
+        tgt_subtoken_idxs = tgt_subtoken_idxs[:self.args.max_tgt_ntokens]
+        if ((not is_test) and len(tgt_subtoken_idxs) < self.args.min_tgt_ntokens):
             return None
 
-        tgt_subtoken_idxs = tokenizer.convert_tokens_to_ids(tgt_subtoken)
-
         tgt_txt = '<q>'.join([' '.join(tt) for tt in tgt])
         src_txt = [original_src_txt[i] for i in idxs]
 
+        src_subtoken_idxs = np.asarray(src_subtoken_idxs, dtype=np.int32)
         return src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt, graph_subtoken_idxs, neg_graph_subtoken_idxs, graph
 
 class PubBertCiteData():
@@ -843,7 +902,7 @@ class PubBertCiteData():
         self.args = args
         #self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
         #model_name = 'microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract'
-        self.tokenizer = tokenizer#AutoTokenizer.from_pretrained(model_name)
+        self.tokenizer = _get_tokenizer()#AutoTokenizer.from_pretrained(model_name)
         self.sep_token = '[SEP]'
         self.cls_token = '[CLS]'
         self.pad_token = '[PAD]'
@@ -854,6 +913,8 @@ class PubBertCiteData():
         self.sep_vid = self.tokenizer.vocab[self.sep_token]
         self.cls_vid = self.tokenizer.vocab[self.cls_token]
         self.pad_vid = self.tokenizer.vocab[self.pad_token]
+        self.tgt_bos_vid, self.tgt_eos_vid, self.tgt_sent_split_vid = self.tokenizer.convert_tokens_to_ids(
+            [self.tgt_bos, self.tgt_eos, self.tgt_sent_split])
 
     def preprocess(self, src, tgt, sent_labels, graph_src, neg_graph_src, graph, use_bert_basic_tokenizer=False, is_test=False):
 
@@ -878,60 +939,35 @@ class PubBertCiteData():
             return None
 
         src_txt = [' '.join(sent) for sent in src]
-        text = ' {} {} '.format(self.sep_token, self.cls_token).join(src_txt)
         graph_subtoken_idxs = []
         neg_graph_subtoken_idxs=[]
         if graph_src != []:
             for each_graph_srcs in graph_src:
-                subtoken_idxs = []
-                #print("each_graph:", each_graph_srcs)
-                #for each_graph_src in each_graph_srcs:
-                each_src = [' '.join(sent) for sent in each_graph_srcs]
-                each_text = ' {} {} '.format(self.sep_token, self.cls_token).join(each_src)
-                each_graph_src_subtokens = tokenizer.tokenize(each_text)
-                each_graph_src_subtokens = [self.cls_token] + each_graph_src_subtokens + [self.sep_token]
-                each_graph_subtoken_idxs = tokenizer.convert_tokens_to_ids(each_graph_src_subtokens)
-                #subtoken_idxs.append(each_graph_subtoken_idxs)
-                #print(each_graph_subtoken_idxs)
-                graph_subtoken_idxs.append(each_graph_subtoken_idxs)
+                graph_subtoken_idxs.append(
+                    _sents_to_ids(each_graph_srcs, self.cls_vid, self.sep_vid))
 
             for each_graph_srcs in neg_graph_src:
-                #subtoken_idxs = []
-                #for each_graph_src in each_graph_srcs:
-                each_src = [' '.join(sent) for sent in each_graph_srcs]
-                each_text = ' {} {} '.format(self.sep_token, self.cls_token).join(each_src)
-                each_graph_src_subtokens = tokenizer.tokenize(each_text)
-                each_graph_src_subtokens = [self.cls_token] + each_graph_src_subtokens + [self.sep_token]
-                each_graph_subtoken_idxs = tokenizer.convert_tokens_to_ids(each_graph_src_subtokens)
-                #subtoken_idxs.append(each_graph_subtoken_idxs)
-                neg_graph_subtoken_idxs.append(each_graph_subtoken_idxs)
+                neg_graph_subtoken_idxs.append(
+                    _sents_to_ids(each_graph_srcs, self.cls_vid, self.sep_vid))
 
         #print(graph_subtoken_idxs)
-        src_subtokens = tokenizer.tokenize(text)
-        src_subtokens = [self.cls_token] + src_subtokens + [self.sep_token]
-        src_subtoken_idxs = tokenizer.convert_tokens_to_ids(src_subtokens)
-        _segs = [-1] + [i for i, t in enumerate(src_subtoken_idxs) if t == self.sep_vid]
-        segs = [_segs[i] - _segs[i - 1] for i in range(1, len(_segs))]
-        segments_ids = []
-        for i, s in enumerate(segs):
-            if (i % 2 == 0):
-                segments_ids += s * [0]
-            else:
-                segments_ids += s * [1]
-        cls_ids = [i for i, t in enumerate(src_subtoken_idxs) if t == self.cls_vid]
+        # Sentences are encoded in one batch by the Rust tokenizer and the
+        # [CLS]/[SEP] ids spliced in, which matches tokenizing `text`.
+        src_subtoken_idxs = _join_ids(_batch_ids(src_txt),
+                                      self.cls_vid, [self.sep_vid, self.cls_vid], self.sep_vid)
+        segments_ids, cls_ids = _segments_and_cls_ids(src_subtoken_idxs, self.sep_vid, self.cls_vid)
         sent_labels = sent_labels[:len(cls_ids)]
 
-        tgt_subtokens_str = '[unused0] ' + ' [unused2] '.join(
-            [' '.join(tokenizer.tokenize(' '.join(tt))) for tt in tgt]) + ' [unused1]'
-        tgt_subtoken = tgt_subtokens_str.split()[:self.args.max_tgt_ntokens]
-        if ((not is_test) and len(tgt_subtoken) < self.args.min_tgt_ntokens):
+        tgt_subtoken_idxs = _join_ids(_batch_ids([' '.join(tt) for tt in tgt]),
+                                      self.tgt_bos_vid, [self.tgt_sent_split_vid], self.tgt_eos_vid)
+        tgt_subtoken_idxs = tgt_subtoken_idxs[:self.args.max_tgt_ntokens]
+        if ((not is_test) and len(tgt_subtoken_idxs) < self.args.min_tgt_ntokens):
             return None
 
-        tgt_subtoken_idxs = tokenizer.convert_tokens_to_ids(tgt_subtoken)
-
         tgt_txt = '<q>'.join([' '.join(tt) for tt in tgt])
         src_txt = [original_src_txt[i] for i in idxs]
 
+        src_subtoken_idxs = np.asarray(src_subtoken_idxs, dtype=np.int32)
         return src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt, graph_subtoken_idxs, neg_graph_subtoken_idxs, graph
 
 def format_to_bert(args):
@@ -946,7 +982,8 @@ def format_to_bert(args):
             a_lst.append((corpus_type, json_f, args, pjoin(args.save_path, real_name.replace('json', 'bert.pt'))))
         #print(a_lst)
         pool = Pool(args.n_cpus)
-        for d in pool.imap(_format_to_bert, a_lst):
+        for d in pool.imap_unordered(_format_to_bert, a_lst,
+                                     chunksize=max(1, len(a_lst) // (args.n_cpus * 8))):
             pass
 
         pool.close()
@@ -985,7 +1022,7 @@ def _format_to_bert(params):
         datasets.append(b_data_dict)
     logger.info('Processed instances %d' % len(datasets))
     logger.info('Saving to %s' % save_file)
-    torch.save(datasets, save_file)
+    torch.save(datasets, save_file, pickle_protocol=pickle.HIGHEST_PROTOCOL)
     datasets = []
     gc.collect()
 
@@ -1015,7 +1052,8 @@ def format_to_lines(args):
         pool = Pool(args.n_cpus)
         dataset = []
         p_ct = 0
-        for d in pool.imap_unordered(_format_to_lines, a_lst):
+        for d in pool.imap_unordered(_format_to_lines, a_lst,
+                                     chunksize=max(1, len(a_lst) // (args.n_cpus * 8))):
             dataset.append(d)
             if (len(dataset) > args.shard_size):
                 pt_file = "{:s}.{:s}.{:d}.json".format(args.save_path, corpus_type, p_ct)
@@ -1064,7 +1102,8 @@ def format_xsum_to_lines(args):
         pool = Pool(args.n_cpus)
         dataset = []
         p_ct = 0
-        for d in pool.imap_unordered(_format_xsum_to_lines, a_lst):
+        for d in pool.imap_unordered(_format_xsum_to_lines, a_lst,
+                                     chunksize=max(1, len(a_lst) // (args.n_cpus * 8))):
             if (d is None):
                 continue
             dataset.append(d)
@@ -0,0 +1,62 @@
+import random
+import re
+
+import pytest
+
+for _module in ['torch', 'dgl', 'transformers', 'pytorch_transformers', 'multiprocess', 'pandas']:
+    pytest.importorskip(_module)
+
+from prepro import data_builder
+from prepro.utils import _get_word_ngrams
+
+
+def _reference_greedy_selection(doc_sent_list, abstract_sent_list, summary_size):
+    """ greedy_selection as it was when every candidate went through cal_rouge. """
+    def _rouge_clean(s):
+        return re.sub(r'[^a-zA-Z0-9 ]', '', s)
+
+    max_rouge = 0.0
+    abstract = sum(abstract_sent_list, [])
+    abstract = _rouge_clean(' '.join(abstract)).split()
+    sents = [_rouge_clean(' '.join(s)).split() for s in doc_sent_list]
+    evaluated_1grams = [_get_word_ngrams(1, [sent]) for sent in sents]
+    reference_1grams = _get_word_ngrams(1, [abstract])
+    evaluated_2grams = [_get_word_ngrams(2, [sent]) for sent in sents]
+    reference_2grams = _get_word_ngrams(2, [abstract])
+
+    selected = []
+    for s in range(summary_size):
+        cur_max_rouge = max_rouge
+        cur_id = -1
+        for i in range(len(sents)):
+            if (i in selected):
+                continue
+            c = selected + [i]
+            candidates_1 = set.union(*map(set, [evaluated_1grams[idx] for idx in c]))
+            candidates_2 = set.union(*map(set, [evaluated_2grams[idx] for idx in c]))
+            rouge_1 = data_builder.cal_rouge(candidates_1, reference_1grams)['f']
+            rouge_2 = data_builder.cal_rouge(candidates_2, reference_2grams)['f']
+            rouge_score = rouge_1 + rouge_2
+            if rouge_score > cur_max_rouge:
+                cur_max_rouge = rouge_score
+                cur_id = i
+        if (cur_id == -1):
+            return selected, cur_max_rouge
+        selected.append(cur_id)
+        max_rouge = cur_max_rouge
+
+    return sorted(selected), max_rouge
+
+
+def test_greedy_selection_matches_cal_rouge_on_ties():
+    # A tiny vocabulary makes exact F1 ties between candidates common.
+    rng = random.Random(0)
+    for _ in range(5000):
+        words = ['w%d' % i for i in range(rng.randint(2, 6))]
+        doc = [[rng.choice(words) for _ in range(rng.randint(0, 5))]
+               for _ in range(rng.randint(1, 10))]
+        abstract = [[rng.choice(words) for _ in range(rng.randint(0, 6))]
+                    for _ in range(rng.randint(1, 3))]
+        summary_size = rng.randint(1, 4)
+        assert data_builder.greedy_selection(doc, abstract, summary_size) \
+            == _reference_greedy_selection(doc, abstract, summary_size)
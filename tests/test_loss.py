@@ -0,0 +1,40 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('fastNLP')
+
+import torch.nn as nn
+
+from models import loss as loss_module
+
+
+def _reported_loss(monkeypatch, fused, output, target, vocab_size, label_smoothing):
+    monkeypatch.setattr(loss_module, '_FUSED_LABEL_SMOOTHING', fused)
+    torch.manual_seed(0)
+    generator = nn.Sequential(nn.Linear(output.size(-1), vocab_size), nn.LogSoftmax(dim=-1))
+    compute = loss_module.NMTLossCompute(generator, {'PAD': 0}, vocab_size,
+                                         label_smoothing=label_smoothing)
+    assert (compute.criterion is None) == fused
+    with torch.no_grad():
+        _, stats = compute._compute_loss(None, output, target, None, None, None)
+    return float(stats.loss), float(stats.n_words)
+
+
+def test_fused_label_smoothing_reports_same_loss(monkeypatch):
+    if not loss_module._FUSED_LABEL_SMOOTHING:
+        pytest.skip('cross_entropy has no label_smoothing in this torch')
+    torch.manual_seed(1)
+    vocab_size, label_smoothing = 500, 0.1
+    output = torch.randn(4, 7, 16)
+    target = torch.randint(1, vocab_size, (4, 7))
+    target[:, -2:] = 0
+
+    fused, n_fused = _reported_loss(monkeypatch, True, output, target, vocab_size, label_smoothing)
+    kl, n_kl = _reported_loss(monkeypatch, False, output, target, vocab_size, label_smoothing)
+
+    assert n_fused == n_kl
+    # The two smoothed targets differ only in how the smoothing mass
+    # treats the padding and gold entries.
+    assert math.isclose(fused / n_fused, kl / n_kl, rel_tol=1e-3)
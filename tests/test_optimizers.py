@@ -0,0 +1,98 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import torch.nn as nn
+
+from models.neural import MultiHeadedAttention
+from models.optimizers import remap_fused_qkv_state
+
+
+class _SplitAttention(nn.Module):
+    """ Parameter layout of `MultiHeadedAttention` before the fused projection. """
+
+    def __init__(self, model_dim):
+        super(_SplitAttention, self).__init__()
+        self.linear_keys = nn.Linear(model_dim, model_dim)
+        self.linear_values = nn.Linear(model_dim, model_dim)
+        self.linear_query = nn.Linear(model_dim, model_dim)
+        self.final_linear = nn.Linear(model_dim, model_dim)
+
+
+def _split_grads(old):
+    return [torch.randn_like(p) for p in old.parameters()]
+
+
+def _fused_grads(old, grads):
+    g = dict(zip([n for n, _ in old.named_parameters()], grads))
+    return [torch.cat([g['linear_query.weight'], g['linear_keys.weight'], g['linear_values.weight']], 0),
+            torch.cat([g['linear_query.bias'], g['linear_keys.bias'], g['linear_values.bias']], 0),
+            g['final_linear.weight'], g['final_linear.bias']]
+
+
+def _step(model, optimizer, grads):
+    for p, g in zip(model.parameters(), grads):
+        p.grad = g
+    optimizer.step()
+
+
+def test_old_checkpoint_round_trip():
+    torch.manual_seed(0)
+    old = _SplitAttention(8)
+    old_optim = torch.optim.Adam(old.parameters(), lr=1e-2)
+    for _ in range(3):
+        _step(old, old_optim, _split_grads(old))
+
+    new = MultiHeadedAttention(2, 8, dropout=0.0)
+    new.load_state_dict(old.state_dict())
+    new_optim = torch.optim.Adam(new.parameters(), lr=1e-2)
+    new_optim.load_state_dict(
+        remap_fused_qkv_state(old_optim.state_dict(), list(new.named_parameters())))
+
+    grads = _split_grads(old)
+    _step(old, old_optim, grads)
+    _step(new, new_optim, _fused_grads(old, grads))
+
+    fused = torch.cat([old.linear_query.weight, old.linear_keys.weight, old.linear_values.weight], 0)
+    assert torch.allclose(new.linear_qkv.weight, fused)
+    assert torch.allclose(new.final_linear.weight, old.final_linear.weight)
+
+
+def test_fused_state_is_unchanged():
+    model = MultiHeadedAttention(2, 8)
+    optimizer = torch.optim.Adam(model.parameters())
+    state_dict = optimizer.state_dict()
+    assert remap_fused_qkv_state(state_dict, list(model.named_parameters())) is state_dict
+
+
+def test_mismatched_state_raises():
+    old = nn.Sequential(nn.Linear(8, 8), nn.Linear(8, 8), nn.Linear(8, 8))
+    optimizer = torch.optim.Adam(old.parameters())
+    with pytest.raises(RuntimeError):
+        remap_fused_qkv_state(optimizer.state_dict(),
+                              list(MultiHeadedAttention(2, 8).named_parameters()))
+
+
+def test_model_builder_resumes_old_checkpoint():
+    for module in ['dgl', 'transformers', 'fastNLP', 'scipy']:
+        pytest.importorskip(module)
+    import argparse
+
+    from models import model_builder
+    from models.optimizers import Optimizer
+
+    torch.manual_seed(0)
+    old = _SplitAttention(8)
+    optim = Optimizer('adam', 1e-2, 0, decay_method='noam', warmup_steps=10)
+    optim.set_parameters(list(old.named_parameters()))
+    _step(old, optim.optimizer, _split_grads(old))
+
+    new = MultiHeadedAttention(2, 8)
+    args = argparse.Namespace(visible_gpus='-1')
+    resumed = model_builder.build_optim(args, new, {'optim': [optim]})
+
+    exp_avg = resumed.optimizer.state[new.linear_qkv.weight]['exp_avg']
+    old_state = optim.optimizer.state
+    assert torch.equal(exp_avg, torch.cat([old_state[old.linear_query.weight]['exp_avg'],
+                                           old_state[old.linear_keys.weight]['exp_avg'],
+                                           old_state[old.linear_values.weight]['exp_avg']], 0))